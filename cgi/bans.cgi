@@ -13,34 +13,57 @@
 #
 ###
 
+import os
 import sys
 import time
+import tempfile
 import urllib
+import zlib
+import hashlib
+import calendar
+import email.utils
 import ConfigParser
+try:
+    import json
+except ImportError:
+    import simplejson as json
 
 CONFIG_FILENAME = "bantracker.conf"
-config = ConfigParser.RawConfigParser()
-config.add_section('webpage')
-
-# set default values
-config.set('webpage', 'database', '/home/bot/data/bans.db')
-config.set('webpage', 'results_per_page', '100')
-config.set('webpage', 'anonymous_access', 'True')
-config.set('webpage', 'PLUGIN_PATH', '/var/www/bot')
-config.set('webpage', 'irc_network', 'irc.freenode.net')
-config.set('webpage', 'irc_channel', '#ubuntu-ops')
 
+# bans.wsgi runs this script for every request and keeps what is in shared
+# between them, as a CGI script it starts empty.
 try:
-    config.readfp(open(CONFIG_FILENAME))
-except IOError:
+    shared
+except NameError:
+    shared = {}
+
+if 'config' in shared:
+    config = shared['config']
+else:
+    config = ConfigParser.RawConfigParser()
+    config.add_section('webpage')
+
+    # set default values
+    config.set('webpage', 'database', '/home/bot/data/bans.db')
+    config.set('webpage', 'results_per_page', '100')
+    config.set('webpage', 'anonymous_access', 'True')
+    config.set('webpage', 'PLUGIN_PATH', '/var/www/bot')
+    config.set('webpage', 'irc_network', 'irc.freenode.net')
+    config.set('webpage', 'irc_channel', '#ubuntu-ops')
+    config.set('webpage', 'log_cache', '')
+
     try:
-        config.write(open(CONFIG_FILENAME, 'w'))
+        config.readfp(open(CONFIG_FILENAME))
     except IOError:
-        pass
+        try:
+            config.write(open(CONFIG_FILENAME, 'w'))
+        except IOError:
+            pass
+    shared['config'] = config
 
 # This needs to be set to the location of the commoncgi.py file
 PLUGIN_PATH = config.get('webpage', 'PLUGIN_PATH')
-if PLUGIN_PATH:
+if PLUGIN_PATH and PLUGIN_PATH not in sys.path:
     sys.path.append(PLUGIN_PATH)
 
 try:
@@ -57,12 +80,19 @@ num_per_page = config.getint('webpage', 'results_per_page')
 anonymous_access = config.getboolean('webpage', 'anonymous_access')
 irc_network = config.get('webpage', 'irc_network')
 irc_channel = config.get('webpage', 'irc_channel')
+log_cache = config.get('webpage', 'log_cache')
+
+# the ETags of the logs change with log_etag_version, update it when the log
+# pages change
+log_etag_version = 1
+log_max_age = 7 * 24 * 3600
 
 t1 = time.time()
 
 try:
-    con = sqlite.connect(db)
+    con = shared.get('con') or sqlite.connect(db)
     cur = con.cursor()
+    shared['con'] = con
 except sqlite.DatabaseError:
     print >> sys.stderr, "Unable to connect to to database '%s'" % db
     send_page('bans.tmpl')
@@ -75,28 +105,177 @@ def db_execute(query, args):
         print >> sys.stderr, "The database is locked, wait a bit and try again."
         send_page('bans.tmpl')
 
+try:
+    send_stream
+except NameError:
+    # bans.wsgi has its own send_stream and environ
+    environ = os.environ
+
+    def send_stream(chunks, headers=(), status='200 OK'):
+        """Sends the page in <chunks> as they are made, send_page buffers the
+        whole page."""
+        out = sys.__stdout__
+        if status != '200 OK':
+            out.write("Status: %s\n" % status)
+        headers = list(headers)
+        if 'Content-Type' not in [ h[0] for h in headers ]:
+            headers.insert(0, ('Content-Type', 'text/html'))
+        for header in headers:
+            out.write("%s: %s\n" % header)
+        out.write("\n")
+        for chunk in chunks:
+            if isinstance(chunk, unicode):
+                chunk = chunk.encode('utf-8')
+            out.write(chunk)
+            out.flush()
+        sys.exit(0)
+
+def toEpoch(x):
+    """Returns the seconds since the epoch of a time column"""
+    if x is None:
+        return None
+    return calendar.timegm(readTime(x).utctimetuple())
+
+def toUnicode(s):
+    """Decodes the UTF-8 strings of the database, which might not be valid"""
+    if isinstance(s, str):
+        return s.decode('utf-8', 'replace')
+    return s
+
+def jsonString(s):
+    return json.dumps(toUnicode(s))
+
+def send_json(obj, headers=()):
+    """Sends <obj> encoded as JSON, or 304 Not Modified if the client already
+    has it."""
+    body = json.dumps(obj, separators=(',', ':'), sort_keys=True)
+    etag = '"%s"' % hashlib.sha1(body).hexdigest()
+    headers = [('Content-Type', 'application/json'), ('ETag', etag)] + list(headers)
+    if environ.get('HTTP_IF_NONE_MATCH') == etag:
+        send_stream([], headers, '304 Not Modified')
+    send_stream([body], headers)
+
+def templateChunks(template, chunks, errors=''):
+    """Returns the page made with <template> and the body <chunks>, like
+    send_page does."""
+    head, tail = open(template).read().split('%s', 1)
+    yield head.replace('%e', errors)
+    for chunk in chunks:
+        yield chunk
+    yield tail
+
+def readCache(filename):
+    """Returns the data saved in <filename>, or None."""
+    try:
+        f = open(filename, 'rb')
+    except IOError:
+        return None
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+def writeCache(filename, data):
+    """Saves <data> in <filename>, errors are ignored."""
+    # a unique name, bans.wsgi can write the same log from several threads
+    try:
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(filename))
+    except (IOError, OSError):
+        return
+    try:
+        f = os.fdopen(fd, 'wb')
+        try:
+            f.write(data)
+        finally:
+            f.close()
+        os.rename(tmp, filename)
+    except (IOError, OSError):
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+
+def searchWords(text):
+    """Returns the set of words of <text> in the search index, the same as
+    searchWords in the plugin."""
+    return set([ w for w in re.findall(r'\w+', text.lower()) if 1 < len(w) <= 32 ])
+
+def readTime(x):
+    """Returns the datetime of a time column, either seconds since the epoch
+    or a pickled datetime for rows not yet converted by @btmigrate."""
+    if isinstance(x, basestring) and not x.isdigit():
+        return pickle.loads(x)
+    return datetime.datetime.fromtimestamp(int(x), pytz.UTC)
+
+def getLogBlocks(id):
+    """Returns the log of the ban <id> as a list of (compressed, data) blocks,
+    old bans have the whole log in bans.log"""
+    log = db_execute("SELECT log FROM bans WHERE id=%s", id).fetchall()
+    if not log:
+        return None
+    if log[0][0]:
+        return [(0, log[0][0])]
+    return db_execute("SELECT log_blocks.compressed, log_blocks.data FROM ban_logs, log_blocks "
+                      "WHERE ban_logs.block_id = log_blocks.id AND ban_logs.ban_id=%s "
+                      "ORDER BY ban_logs.seq", id).fetchall()
+
+def decodeLogBlock(compressed, data):
+    if int(compressed):
+        return zlib.decompress(data.decode('base64'))
+    return data
+
+def logLines(blocks, start=0, count=None):
+    """Returns an iterator over the lines <start> to <start> + <count> of the
+    log <blocks>, and whether there are lines before them. A negative <start>
+    counts from the end of the log. Blocks are only decoded when needed."""
+    if start < 0:
+        # the ban is at the end of the log, decode the blocks backwards
+        lines = []
+        i = len(blocks)
+        while i > 0 and len(lines) < -start:
+            i -= 1
+            lines[0:0] = decodeLogBlock(*blocks[i]).splitlines()
+        earlier = i > 0 or len(lines) > -start
+        lines = lines[start:]
+        if count is not None:
+            lines = lines[:count]
+        return iter(lines), earlier
+    def iterLines():
+        n = 0
+        for compressed, data in blocks:
+            for line in decodeLogBlock(compressed, data).splitlines():
+                if count is not None and n >= start + count:
+                    return
+                if n >= start:
+                    yield line
+                n += 1
+    return iterLines(), start > 0
+
 # Login check
 error = ''
 user = None
 
-# Delete old sessions
-try:
-    session_timeout = int(time.time()) - (2592000 * 3)
-    cur.execute('DELETE FROM sessions WHERE time < %d', (session_timeout,))
-except:
-    pass
-
-# Session handling
+# Session handling, the plugin deletes the old sessions
+session_timeout = 2592000 * 3
 if 'sess' in form:
     cookie['sess'] = form['sess'].value
 if 'sess' in cookie:
     sess = cookie['sess'].value
-    try:
-        cur.execute('SELECT user FROM sessions WHERE session_id=%s',(sess,))
-        user = cur.fetchall()[0][0]
-    except:
-        con.commit()
-        pass
+    # bans.wsgi keeps the sessions already checked for a few minutes
+    sessions = shared.setdefault('sessions', {})
+    if sess in sessions and sessions[sess][1] > time.time():
+        user = sessions[sess][0]
+    else:
+        try:
+            cur.execute('SELECT user FROM sessions WHERE session_id=%s AND time > %s',
+                        (sess, int(time.time()) - session_timeout))
+            user = cur.fetchall()[0][0]
+            if len(sessions) > 1000:
+                sessions.clear()
+            sessions[sess] = (user, time.time() + 300)
+        except:
+            con.commit()
+            pass
 
 if not user and not anonymous_access:
     print "Sorry, bantracker is not available for anonymous users<br />"
@@ -109,7 +288,7 @@ def urlencode(**kwargs):
     """Return the url options as a string, inserting additional ones if given."""
     d = dict([ (i.name, i.value) for i in form.list ])
     d.update(kwargs)
-    return urllib.urlencode(d.items())
+    return urllib.urlencode([ (k, v) for k, v in d.items() if v is not None ])
 
 def isTrue(value):
     """Returns True if the form value is one of "1", "true", "yes", or "on", case insensitive"""
@@ -146,6 +325,19 @@ if 'log' in form:
 
     if 'plain' in form and isTrue(form['plain'].value):
         plain = True
+    json_mode = 'format' in form and form['format'].value == 'json'
+
+    # only the lines <start> to <start> + <count> are shown if given, the
+    # inline viewer loads the end of the log
+    start = 0
+    count = None
+    try:
+        if 'start' in form:
+            start = int(form['start'].value)
+        if 'count' in form:
+            count = int(form['count'].value)
+    except ValueError:
+        pass
 
     if 'mark' in form:
         mark = True
@@ -154,9 +346,39 @@ if 'log' in form:
             regex = True
             regex_value = 'checked="checked"'
 
-    log = db_execute("SELECT log FROM bans WHERE id=%s", log_id).fetchall()
-
-    if not log or not log[0] or not log[0][0]:
+    # A log never changes once stored, so the ETag only depends on the page
+    # asked for, and a conditional request is answered before reading it.
+    etag = '"%s"' % hashlib.sha1(repr((log_etag_version, log_id, plain, json_mode,
+                                       start, count, mark_value, regex))).hexdigest()
+    headers = [('ETag', etag)]
+    if json_mode:
+        headers.insert(0, ('Content-Type', 'application/json'))
+    if anonymous_access:
+        headers.append(('Cache-Control', 'public, max-age=%d' % log_max_age))
+    else:
+        headers.append(('Cache-Control', 'private, max-age=%d' % log_max_age))
+    cacheable = environ.get('REQUEST_METHOD', 'GET') in ('GET', 'HEAD')
+    if cacheable and environ.get('HTTP_IF_NONE_MATCH') == etag:
+        send_stream([], headers, '304 Not Modified')
+    # only the whole log is cached, one file per ban, the lines asked for
+    # and the highlights are picked from it.
+    blocks = None
+    cache_file = None
+    if log_cache and log_id.isdigit():
+        cache_file = os.path.join(log_cache, 'log-%d' % int(log_id))
+        data = readCache(cache_file)
+        if data is not None:
+            blocks = [(0, data)]
+    if blocks is None:
+        blocks = getLogBlocks(log_id)
+        if blocks and cache_file:
+            writeCache(cache_file, '\n'.join([ line for block in blocks
+                                               for line in decodeLogBlock(*block).splitlines() ]))
+
+    if not blocks:
+        if json_mode:
+            send_stream([json.dumps({'error': 'No such log with ID: %s' % log_id})],
+                        [('Content-Type', 'application/json')], '404 Not Found')
         if plain:
             print >> sys.stderr, '<div id="error">No such log with ID: %s' % q(log_id)
             send_page('empty.tmpl')
@@ -164,69 +386,97 @@ if 'log' in form:
             print >> sys.stderr, 'No such log with ID: %s' % q(log_id)
             send_page('log.tmpl')
 
-    log = log[0][0]
-
-    if not plain:
-        print '  <div class="main">'
-        print '    <form id="hform" action="" method="get">'
-        print '      <fieldset>'
-        print '        <input type="hidden" name="log" id="log" value="%s">' % q(log_id)
-        print '        <label for="mark">Highlight:</label>'
-        print '        <input type="text" name="mark" id="mark" value="%s"/>' % q(mark_value)
-        print '        <input type="checkbox" name="regex" id="regex" %s>' % regex_value
-        print '        <label for="regex">Regex</label>'
-        print '      </fieldset>'
-        print '      <input class="input" type="submit" id="hform_submit" value="Update">'
-        print '    </form>'
-        print '  </div>'
-
-    pad = '<br />'
-    if plain:
-        pad = ''
-        print '<pre id="textlog">'
-    else:
-        print '<div id="textlog">'
+    lines, earlier = logLines(blocks, start, count)
 
+    errors = ''
     if mark:
         if regex:
             try:
                 mark = re.compile(mark_value, re.I)
             except:
-                print >> sys.stderr, "Malformed regex %r" % mark_value
+                errors = q("Malformed regex %r" % mark_value)
                 mark = False
         else:
             escaped = re.escape(mark_value).replace('%', '.*')
             mark = re.compile(escaped, re.I)
 
-    lines = log.splitlines()
-    for line in lines:
-        if plain:
-            print q(line)
-        elif mark:
-            if mark.search(line):
-                print ' <span class="highlight">%s</span>%s' % (q(line), pad)
+    def jsonChunks():
+        yield '{"id":%s,"earlier":%s,"lines":[' % (log_id.isdigit() and log_id or jsonString(log_id),
+                                                 json.dumps(earlier))
+        sep = ''
+        L = []
+        for line in lines:
+            L.append(jsonString(line))
+            if len(L) == 200:
+                yield sep + ','.join(L)
+                sep = ','
+                L = []
+        if L:
+            yield sep + ','.join(L)
+        yield ']}'
+
+    def plainChunks():
+        yield '<pre id="textlog">\n'
+        if earlier:
+            yield '<a href="bans.cgi?log=%s">Earlier lines are in the full log</a>\n' % q(log_id)
+        L = []
+        for line in lines:
+            L.append(q(line))
+            if len(L) == 200:
+                yield '\n'.join(L) + '\n'
+                L = []
+        yield '\n'.join(L) + '\n</pre>\n'
+
+    def pageChunks():
+        yield """  <div class="main">
+    <form id="hform" action="" method="get">
+      <fieldset>
+        <input type="hidden" name="log" id="log" value="%s">
+        <label for="mark">Highlight:</label>
+        <input type="text" name="mark" id="mark" value="%s"/>
+        <input type="checkbox" name="regex" id="regex" %s>
+        <label for="regex">Regex</label>
+      </fieldset>
+      <input class="input" type="submit" id="hform_submit" value="Update">
+    </form>
+  </div>
+<div id="textlog">
+""" % (q(log_id), q(mark_value), regex_value)
+        if earlier:
+            yield '<a href="?log=%s">Earlier lines</a><br />\n' % q(log_id)
+        L = []
+        for line in lines:
+            if mark:
+                if mark.search(line):
+                    L.append(' <span class="highlight">%s</span><br />' % q(line))
+                else:
+                    L.append(" <span>%s</span><br />" % q(line))
             else:
-                print " <span>%s</span>%s" % (q(line), pad)
-        else:
-            print '  <span>%s</span>%s' % (q(line), pad)
-
-    if plain:
-        print '</pre>'
-        send_page('empty.tmpl')
-
-    print '</div><br />'
-    print '<div>'
-    print ' <form id="comment_form" action="" method="post">'
-    print '  <fieldset>'
-    print '   <legend>Add a comment</legend>'
-    print '   <textarea cols="50" rows="5" class="input" name="comment"></textarea><br />'
-    print '   <input type="hidden" name="comment_id" value="%s" />' % log_id
-    print '   <input class="submit" type="submit" value="Send" />'
-    print '  </fieldset>'
-    print ' </form>'
-    print '</div>'
-
-    send_page('log.tmpl')
+                L.append('  <span>%s</span><br />' % q(line))
+            if len(L) == 200:
+                yield '\n'.join(L) + '\n'
+                L = []
+        yield '\n'.join(L) + '\n'
+        yield """</div><br />
+<div>
+ <form id="comment_form" action="" method="post">
+  <fieldset>
+   <legend>Add a comment</legend>
+   <textarea cols="50" rows="5" class="input" name="comment"></textarea><br />
+   <input type="hidden" name="comment_id" value="%s" />
+   <input class="submit" type="submit" value="Send" />
+  </fieldset>
+ </form>
+</div>
+""" % q(log_id)
+
+    if json_mode:
+        chunks = jsonChunks()
+    elif plain:
+        chunks = plainChunks()
+    else:
+        chunks = templateChunks('log.tmpl', pageChunks(), errors)
+    send_stream(chunks, headers)
 
 # Main page
 # Process comments
@@ -236,7 +486,14 @@ if 'comment' in form and 'comment_id' in form and user:
     if not len(comm):
         try:
             cur.execute('INSERT INTO comments (ban_id, who, comment, time) VALUES (%s, %s, %s, %s)',
-                        (form['comment_id'].value, user,form['comment'].value, pickle.dumps(datetime.datetime.now(pytz.UTC))))
+                        (form['comment_id'].value, user,form['comment'].value, int(time.time())))
+            cur.execute('SELECT word FROM comment_words WHERE ban_id=%s', (form['comment_id'].value,))
+            indexed = set([ row[0] for row in cur.fetchall() ])
+            for word in searchWords(form['comment'].value) - indexed:
+                cur.execute('INSERT INTO comment_words (word, ban_id) VALUES (%s, %s)',
+                            (word, form['comment_id'].value))
+            if form['comment'].value.startswith('**MARK**'):
+                cur.execute("UPDATE ban_types SET type='mark' WHERE ban_id=%s", (form['comment_id'].value,))
             con.commit()
         except sqlite.DatabaseError:
             con.rollback()
@@ -251,9 +508,11 @@ if user:
     print 'Logged in as: %s <br /> ' % user
 
 print 'Timezone: '
-if 'tz' in form and form['tz'].value in pytz.common_timezones:
+if 'timezones' not in shared:
+    shared['timezones'] = frozenset(pytz.common_timezones)
+if 'tz' in form and form['tz'].value in shared['timezones']:
     tz = form['tz'].value
-elif 'tz' in cookie and cookie['tz'].value in pytz.common_timezones:
+elif 'tz' in cookie and cookie['tz'].value in shared['timezones']:
     tz = cookie['tz'].value
 else:
     tz = 'UTC'
@@ -274,6 +533,7 @@ print '</div>'
 tz = pytz.timezone(tz)
 
 haveQuery = 'query' in form or 'channel' in form or 'operator' in form
+json_mode = 'format' in form and form['format'].value == 'json'
 
 def makeInput(name, label, before=False, type="checkbox", extra=''):
     if before:
@@ -297,7 +557,7 @@ print '<div class="search">'
 print '<form action="" method="GET">'
 makeInput("channel", "Channel:", True, "text")
 makeInput("operator", "Operator:", True, "text")
-makeInput("query", "Search:", True, "text", extra="(% and _ are wildcards)")
+makeInput("query", "Search:", True, "text", extra="(% and _ are wildcards, log: and comment: search the logs and comments)")
 
 # Search fields
 print '<div style="float:left">'
@@ -316,7 +576,7 @@ print '</div>'
 print '<div style="clear:both"><input  class="submit" type="submit" value="search" /></div>'
 print '</form></div>'
 
-if not haveQuery:
+if not haveQuery and not json_mode:
     # sqlite2 sucks, getting the last bans takes a lot of time.
     # so lets disable that so at least the page loads quickly.
     ## Maybe we should include a link on the main page for those who do want
@@ -325,9 +585,10 @@ if not haveQuery:
     send_page('bans.tmpl')
 
 # Select and filter bans
-def getBans(id=None, mask=None, kicks=True, oldbans=True, bans=True, marks=True, floodbots=True, operator=None,
-            channel=None, limit=None, offset=0, withCount=False):
-    sql = "SELECT channel, mask, operator, time, removal, removal_op, id FROM bans"
+def banFilter(id=None, mask=None, kicks=True, oldbans=True, bans=True, oldmutes=True, mutes=True,
+              marks=True, floodbots=True, operator=None, channel=None, log=None, comment=None):
+    """Returns the tables, WHERE clause and arguments of a search"""
+    tables = "bans"
     args = []
     where = []
     if id:
@@ -344,44 +605,76 @@ def getBans(id=None, mask=None, kicks=True, oldbans=True, bans=True, marks=True,
     if channel:
         where.append("channel LIKE %s")
         args.append(channel)
-    if not marks:
-        where.append("id NOT IN (SELECT ban_id FROM comments WHERE comment LIKE '**MARK**%%')")
-    if not kicks:
-        where.append("mask LIKE '%%!%%'")
-    if not (oldbans or bans):
-        where.append("mask NOT LIKE '%%!%%'")
-    else:
+    for word in log or ():
+        where.append("id IN (SELECT ban_logs.ban_id FROM log_words, ban_logs "
+                     "WHERE log_words.word=%s AND ban_logs.block_id = log_words.block_id)")
+        args.append(word)
+    for word in comment or ():
+        where.append("id IN (SELECT ban_id FROM comment_words WHERE word=%s)")
+        args.append(word)
+    if not (kicks and oldbans and bans and oldmutes and mutes and marks):
+        # the type of each ban is in ban_types, so any combination of
+        # filters can be paginated by SQL.
+        types = []
         if kicks:
-            s = "(mask NOT LIKE '%%%%!%%%%' OR (mask LIKE '%%%%!%%%%' AND %s))"
-        else:
-            s = "%s"
-        if not oldbans:
-             where.append(s % "removal IS NULL")
-        elif not bans:
-             where.append(s % "removal IS NOT NULL")
+            types.append("type='kick'")
+        if marks:
+            types.append("type='mark'")
+        for type, active, removed in (('ban', bans, oldbans), ('quiet', mutes, oldmutes)):
+            if active and removed:
+                types.append("type='%s'" % type)
+            elif active:
+                types.append("(type='%s' AND removal IS NULL)" % type)
+            elif removed:
+                types.append("(type='%s' AND removal IS NOT NULL)" % type)
+        if not types:
+            types.append("0")
+        tables += ", ban_types"
+        where.append("ban_types.ban_id = bans.id")
+        where.append("(%s)" % " OR ".join(types))
+    return tables, where, args
+
+def getBans(before=None, after=None, limit=None, **kwargs):
+    """Returns the bans matching a search, newest first. Pages are selected
+    by id, <before> or <after> the id of the last ban seen, so deep pages are as
+    fast as the first one."""
+    tables, where, args = banFilter(**kwargs)
+    order = "DESC"
+    if before:
+        where.append("id < %s")
+        args.append(before)
+    elif after:
+        where.append("id > %s")
+        args.append(after)
+        order = "ASC"
+    sql = "SELECT channel, mask, operator, time, removal, removal_op, id FROM %s" % tables
     if where:
-        where = " WHERE " + " AND ".join(where)
-    else:
-        where = ''
-    sql += where
-    sql += " ORDER BY id DESC"
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY id %s" % order
     if limit:
-        sql += " LIMIT %s OFFSET %s" % (limit, offset)
-    #print sql, "<br/>"
-    #print args, "<br/>"
-    # Things seems faster if we do the query BEFORE counting. Due to caches probably.
+        sql += " LIMIT %s" % limit
     bans = db_execute(sql, args).fetchall()
-    count = None
-    if withCount:
-        sql_count = "SELECT count(*) FROM bans%s" % where
-        count = int(db_execute(sql_count, args).fetchone()[0])
-        return bans, count
+    if after:
+        bans.reverse()
     return bans
 
-def filterMutes(item):
-    if item[1][0] == '%':
-        return False
-    return True
+def countBans(**kwargs):
+    tables, where, args = banFilter(**kwargs)
+    sql = "SELECT count(*) FROM %s" % tables
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    return int(db_execute(sql, args).fetchone()[0])
+
+def getComments(ids):
+    """Returns the comments of the bans with <ids> in a dict, by ban id"""
+    comments = {}
+    if not ids:
+        return comments
+    db_execute('SELECT ban_id, who, comment, time FROM comments WHERE ban_id IN (%s) ORDER BY ROWID' % \
+               ','.join([ str(int(id)) for id in ids ]), ())
+    for c in cur.fetchall():
+        comments.setdefault(int(c[0]), []).append(c[1:])
+    return comments
 
 def getQueryTerm(query, term):
     if term[-1] != ':':
@@ -393,16 +686,28 @@ def getQueryTerm(query, term):
         return (query, ret)
     return (query, None)
 
-page = 0
-if 'page' in form:
-    page = int(form['page'].value)
+def formId(k):
+    if k in form and form[k].value.isdigit():
+        return int(form[k].value)
+    return None
+
+before = formId('before')
+after = formId('after')
+ban_count = formId('count')
 
 bans = []
-ban_count = 0
 query = oper = chan = None
+log_words = comment_words = None
 if 'query' in form:
     query = form['query'].value
-
+    query, log_words = getQueryTerm(query, 'log')
+    query, comment_words = getQueryTerm(query, 'comment')
+    if log_words:
+        log_words = searchWords(log_words)
+    if comment_words:
+        comment_words = searchWords(comment_words)
+
+newer = older = False
 if query and query.isdigit():
     bans = getBans(id=int(query))
     ban_count = len(bans)
@@ -412,41 +717,30 @@ if not bans:
         chan = form['channel'].value
     if 'operator' in form:
         oper = form['operator'].value
-    
-    filter_mutes = not (isOn('mutes') or isOn('oldmutes'))
-    filter_bans = not (isOn('bans') or isOn('oldbans'))
-    filter_bans_or_mutes =  bool(filter_bans) ^ bool(filter_mutes)
-    if filter_bans_or_mutes:
-        # we are going to filter the mutes from ban list, this sucks, because then we can't
-        # paginate correctly using SQL with LIMIT and OFFSET, so we *have* to get all bans and
-        # paginate manually.
-        limit = offset = None
+
+    search = dict(mask=query, kicks=isOn('kicks'),
+                  oldbans=isOn('oldbans'),
+                  bans=isOn('bans'),
+                  oldmutes=isOn('oldmutes'),
+                  mutes=isOn('mutes'),
+                  marks=isOn('marks'),
+                  floodbots=isOn('floodbots'),
+                  operator=oper,
+                  channel=chan,
+                  log=log_words,
+                  comment=comment_words)
+    # one more ban than shown tells if there is another page
+    bans = getBans(before=before, after=after, limit=num_per_page + 1, **search)
+    more = len(bans) > num_per_page
+    if after:
+        bans = bans[-num_per_page:]
+        newer, older = more, True
     else:
-        limit = num_per_page
-        offset = num_per_page * page
-    bans, ban_count = getBans(mask=query, kicks=isOn('kicks'),
-                               oldbans=isOn('oldbans') or isOn('oldmutes'),
-                               bans=isOn('bans') or isOn('mutes'),
-                               marks=isOn('marks'),
-                               floodbots=isOn('floodbots'),
-                               operator=oper,
-                               channel=chan,
-                               limit=limit,
-                               offset=offset,
-                               withCount=True)
-
-    #print 'filtering', filter_bans_or_mutes, '<br/>'
-    #print "total count", ban_count, "bans", len(bans), '<br/>'
-    if filter_bans_or_mutes:
-        if filter_mutes:
-            bans = filter(lambda x: filterMutes(x), bans)
-        elif filter_bans:
-            bans = filter(lambda x: not filterMutes(x), bans)
-        ban_count = len(bans)
-        # pick the bans for current page, since we didn't do it with SQL
-        if ban_count > num_per_page:
-            bans = bans[page * num_per_page: (page + 1) * num_per_page]
-    #print "total count after filtering", ban_count, '<br/>'
+        bans = bans[:num_per_page]
+        newer, older = bool(before), more
+    if ban_count is None and not (before or after):
+        # only counted for the first page, the other pages get it in the url
+        ban_count = countBans(**search)
 
 # Sort the bans
 def _sortf(x1,x2,field):
@@ -465,23 +759,49 @@ if 'sort' in form:
             if field >= 10:
                 bans.reverse()
 
+if json_mode:
+    comments = getComments([ b[6] for b in bans ])
+    L = []
+    modified = 0
+    for b in bans:
+        ban = {'id': int(b[6]), 'channel': toUnicode(b[0]), 'mask': toUnicode(b[1]),
+               'operator': toUnicode(b[2]), 'time': toEpoch(b[3]), 'removal': toEpoch(b[4]),
+               'removal_op': toUnicode(b[5]),
+               'comments': [ {'who': toUnicode(c[0]), 'comment': toUnicode(c[1]),
+                              'time': toEpoch(c[2])}
+                             for c in comments.get(int(b[6]), []) ]}
+        modified = max([modified, ban['time'], ban['removal']] +
+                       [ c['time'] for c in ban['comments'] ])
+        L.append(ban)
+    # newer and older are the after and before of the next pages
+    ids = [ ban['id'] for ban in L ]
+    headers = []
+    if modified:
+        headers.append(('Last-Modified', email.utils.formatdate(modified, usegmt=True)))
+    send_json({'count': ban_count, 'bans': L,
+               'newer': ids and newer and max(ids) or None,
+               'older': ids and older and min(ids) or None}, headers)
+
 if haveQuery:
-    if not ban_count:
+    if not bans and not (before or after):
         print '<div style="clear: both">Nothing found.</div>'
     elif ban_count == 1:
         print '<div style="clear: both">Found one match.</div>'
-    else:
+    elif ban_count is not None:
         print '<div style="clear: both">Found %s matches.</div>' % ban_count
 
 # Pagination
 if bans:
-    pagination = '<div style="clear: both">\n&middot;\n'
-    num_pages = int(math.ceil(ban_count / float(num_per_page)))
-    for i in range(num_pages):
-        if page == i:
-            pagination += '<a href="?%s">[%d]</a> &middot;\n' % (urlencode(page=i), i + 1)
-        else:
-            pagination += '<a href="?%s">%d</a> &middot;\n' % (urlencode(page=i), i + 1)
+    ids = [ b[6] for b in bans ]
+    pagination = '<div style="clear: both">\n'
+    if newer:
+        pagination += '<a href="?%s">&laquo; Newer</a>\n' % \
+                urlencode(after=max(ids), before=None, count=ban_count)
+    if newer and older:
+        pagination += '&middot;\n'
+    if older:
+        pagination += '<a href="?%s">Older &raquo;</a>\n' % \
+                urlencode(before=min(ids), after=None, count=ban_count)
     pagination += '</div>\n'
     print pagination
 else:
@@ -516,6 +836,9 @@ print '</tr>'
 print '</thead>'
 print '<tbody>'
 
+# Fetch the comments of all the bans in the page with one query
+comments = getComments([ b[6] for b in bans ])
+
 # And finally, display them!
 i = 0
 for b in bans:
@@ -537,9 +860,9 @@ for b in bans:
         print u'<br /><span class="removal">%s</span>' % b[5]
     print '</td>'
     # Time
-    print '<td id="time-%d">%s' % (b[6], pickle.loads(b[3]).astimezone(tz).strftime("%b %d %Y %H:%M:%S"))
+    print '<td id="time-%d">%s' % (b[6], readTime(b[3]).astimezone(tz).strftime("%b %d %Y %H:%M:%S"))
     if b[4]:                  # Ban removal
-        print '<br /><span class="removal">%s</span>' % pickle.loads(b[4]).astimezone(tz).strftime("%b %d %Y %H:%M:%S")
+        print '<br /><span class="removal">%s</span>' % readTime(b[4]).astimezone(tz).strftime("%b %d %Y %H:%M:%S")
     print '</td>'
     # Log link
     print """<td>
@@ -556,19 +879,18 @@ for b in bans:
         print '<tr class="bg2">'
     else:
         print "<tr>"
-    db_execute('SELECT who, comment, time FROM comments WHERE ban_id=%d', (b[6],))
-    comments = cur.fetchall()
-    if len(comments) == 0:
+    ban_comments = comments.get(int(b[6]), [])
+    if len(ban_comments) == 0:
         print '<td colspan="5" class="comment">'
         print '<div class="invisible" id="comments">%d</div>' % b[6]
         print '<span class="removal">(No comments) </span>'
     else:
         print '<td colspan="5" class="comment" id="comments-%d">' % b[6]
         print '<div class="invisible" id="comments">%d</div>' % b[6]
-        for c in comments:
+        for c in ban_comments:
             print q(c[1]).replace('\n', '<br />')
             print u' <span class="removal"><br />%s, %s</span><br />' % \
-                (c[0],pickle.loads(c[2]).astimezone(tz).strftime("%b %d %Y %H:%M:%S"))
+                (c[0],readTime(c[2]).astimezone(tz).strftime("%b %d %Y %H:%M:%S"))
     if user:
         print """<span class="pseudolink" onclick="toggle('%s','comment')">Add comment</span>""" % b[6]
         print """<div class="invisible" id="comment_%s"><br />""" % b[6]
@@ -7,6 +7,8 @@ window.addEventListener("load", function() {
 
 s = null;
 r = null;
+// lines loaded by the inline log viewer, from the end of the log
+loglines = 500;
 
 function getObj(name) {
   if (document.getElementById) {
@@ -60,7 +62,7 @@ function loadlog(id) {
   var reqUri = "bans.cgi?log=" + id;
   if(qobj.obj.value && qobj.obj.value != '')
     reqUri += "&mark=" + qobj.obj.value.split(' ').pop();
-  reqUri += "&plain=1";
+  reqUri += "&plain=1&start=-" + loglines;
   r.onreadystatechange = printlog;
   r.open("GET", reqUri, true);
   r.send(null);
@@ -68,11 +70,14 @@ function loadlog(id) {
 }
 
 function printlog() {
-  if (r.readyState == 4) {
+  // the log is streamed, show the lines received so far
+  if (r.readyState == 3 || r.readyState == 4) {
     var c = new getObj('log');
     c.obj.innerHTML = r.responseText;
     document.getElementById("loglink-" + s).textContent = "Hide";
     c.style.display = 'block';
+  }
+  if (r.readyState == 4) {
     setupHighlight();
   }
 }
@@ -27,6 +27,87 @@ class SpaceSeparatedListOfTypes(registry.SpaceSeparatedListOf):
     Value = ValidTypes
 
 
+# Tables added to the bans database after the bans, comments and sessions
+# tables, (name, definition, query filling the table with existing data)
+tables = (
+    ('log_blocks', """(
+    id INTEGER PRIMARY KEY,
+    hash VARCHAR(40) NOT NULL,
+    compressed INTEGER NOT NULL,
+    data TEXT NOT NULL
+)""", None),
+    ('ban_logs', """(
+    ban_id INTEGER NOT NULL,
+    seq INTEGER NOT NULL,
+    block_id INTEGER NOT NULL
+)""", None),
+    ('ban_types', """(
+    ban_id INTEGER PRIMARY KEY,
+    type VARCHAR(5) NOT NULL
+)""", """INSERT INTO ban_types (ban_id, type) SELECT id, CASE
+    WHEN id IN (SELECT ban_id FROM comments WHERE comment LIKE '**MARK**%') THEN 'mark'
+    WHEN substr(mask, 1, 1) = '%' THEN 'quiet'
+    WHEN mask LIKE '%!%@%' OR substr(mask, 1, 1) = '$' OR mask LIKE '%(realname)' THEN 'ban'
+    ELSE 'kick' END FROM bans"""),
+    ('log_words', """(
+    word VARCHAR(32) NOT NULL,
+    block_id INTEGER NOT NULL
+)""", None),
+    ('comment_words', """(
+    word VARCHAR(32) NOT NULL,
+    ban_id INTEGER NOT NULL
+)""", None),
+)
+
+# Indexes of the bans database, (name, table(columns))
+indexes = (
+    ('comments_ban_id', 'comments(ban_id)'),
+    ('bans_channel_removal', 'bans(channel, removal)'),
+    ('bans_mask_channel', 'bans(mask, channel)'),
+    ('bans_operator', 'bans(operator)'),
+    ('log_blocks_hash', 'log_blocks(hash)'),
+    ('ban_logs_ban_id', 'ban_logs(ban_id)'),
+    ('ban_types_type', 'ban_types(type)'),
+    ('log_words_word', 'log_words(word)'),
+    ('comment_words_word', 'comment_words(word)'),
+    ('log_words_block_id', 'log_words(block_id)'),
+    ('comment_words_ban_id', 'comment_words(ban_id)'),
+    ('sessions_time', 'sessions(time)'),
+)
+
+def createTables(cur):
+    """Creates the tables missing in the database."""
+    cur.execute("SELECT name FROM sqlite_master WHERE type='table'")
+    existing = set([ row[0] for row in cur.fetchall() ])
+    for name, definition, fill in tables:
+        if name not in existing:
+            cur.execute("CREATE TABLE %s %s" % (name, definition))
+            if fill:
+                cur.execute(fill)
+
+def createIndexes(cur):
+    """Creates the indexes missing in the database."""
+    cur.execute("SELECT name FROM sqlite_master WHERE type='index'")
+    existing = set([ row[0] for row in cur.fetchall() ])
+    for name, on in indexes:
+        if name not in existing:
+            cur.execute("CREATE INDEX %s ON %s" % (name, on))
+
+def upgradeDatabase(con):
+    """Upgrades an existing database to the current schema."""
+    cur = con.cursor()
+    try:
+        createTables(cur)
+        createIndexes(cur)
+    except:
+        con.rollback()
+        raise
+    else:
+        con.commit()
+    finally:
+        cur.close()
+
+
 def configure(advanced):
     from supybot.questions import yn, something, output
     import sqlite
@@ -160,7 +241,8 @@ def configure(advanced):
 )""")
 #"""
 
-        cur.execute("CREATE INDEX comments_ban_id ON comments(ban_id)")
+        createTables(cur)
+        createIndexes(cur)
 
     except:
         con.rollback()
@@ -183,9 +265,39 @@ conf.registerChannelValue(Bantracker, 'enabled',
         registry.Boolean(False, """Enable the bantracker"""))
 conf.registerGlobalValue(Bantracker, 'database',
         registry.String(conf.supybot.directories.data.dirize('bans.db'), "Filename of the bans database", private=True))
+conf.registerGlobalValue(Bantracker.database, 'writeBehind',
+        registry.Boolean(True, "Write bans, comments and sessions to the database in batches"\
+            " from a background thread, instead of while handling the IRC messages."))
 conf.registerGlobalValue(Bantracker, 'bansite',
         registry.String('', "Web site for the bantracker, without the 'bans.cgi' appended", private=True))
 
+conf.registerGroup(Bantracker, 'log')
+conf.registerChannelValue(Bantracker.log, 'depth',
+        registry.PositiveInteger(200,
+            "Number of lines of the channel log kept, and stored with every ban/kick."))
+conf.registerGlobalValue(Bantracker.log, 'compress',
+        registry.Boolean(True,
+            "Compress the stored channel logs with zlib."))
+
+conf.registerGroup(Bantracker, 'nicks')
+conf.registerGlobalValue(Bantracker.nicks, 'size',
+        registry.PositiveInteger(10000,
+            "Number of nick hostmasks remembered, the least recently used are forgotten"\
+            " first, but never those of users in a channel with the bantracker enabled."))
+conf.registerGlobalValue(Bantracker.nicks, 'expire',
+        registry.NonNegativeInteger(7 * 86400,
+            "Seconds after which an unused nick hostmask is forgotten, 0 to keep it"\
+            " until there are more than nicks.size."))
+
+conf.registerGroup(Bantracker, 'sync')
+conf.registerGlobalValue(Bantracker.sync, 'rate',
+        registry.PositiveFloat(0.5,
+            "Number of ban list queries sent per second on each network, whois"\
+            " queries asked for by a command are sent at once and slow them down."))
+conf.registerGlobalValue(Bantracker.sync, 'burst',
+        registry.PositiveInteger(5,
+            "Number of queries that can be sent at once before being limited by sync.rate."))
+
 conf.registerChannelValue(Bantracker, 'request',
         registry.Boolean(False,
             "Enable message requests from bot"))
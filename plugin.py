@@ -54,25 +54,38 @@ import supybot.conf as conf
 import supybot.ircdb as ircdb
 import supybot.schedule as schedule
 import supybot.utils as utils
+import supybot.log as log
 from supybot.utils.str import format as Format
 from fnmatch import fnmatch
-from collections import defaultdict
+from collections import defaultdict, deque
+from contextlib import contextmanager
 import sqlite
 import pytz
 import cPickle
 import datetime
+import calendar
 import csv
 import time
 import random
 import hashlib
+import os
+import heapq
 import threading
+import Queue
+import re
+import zlib
+
+import config
 
 isUserHostmask = ircutils.isUserHostmask
 
 tz = 'UTC'
 
+# Times in the database are stored as seconds since the epoch, bans and
+# comments stored by older versions have pickled datetime objects until they
+# are converted with the btmigrate command.
 def now():
-    return cPickle.dumps(datetime.datetime.now(pytz.timezone(tz)))
+    return int(time.time())
 
 def nowSeconds():
     # apparently time.time() isn't the same thing.
@@ -80,7 +93,24 @@ def nowSeconds():
     return int(time.mktime(time.gmtime()))
 
 def fromTime(x):
-    return cPickle.dumps(datetime.datetime(*time.gmtime(x)[:6], **{'tzinfo': pytz.timezone("UTC")}))
+    return int(x)
+
+def isPickledTime(x):
+    return isinstance(x, basestring) and not x.isdigit()
+
+def readTime(x):
+    """Returns the datetime, in UTC, of a time column"""
+    if x is None:
+        return None
+    if isPickledTime(x):
+        return cPickle.loads(x).astimezone(pytz.UTC)
+    return datetime.datetime.fromtimestamp(int(x), pytz.UTC)
+
+def toEpoch(x):
+    """Converts a pickled datetime column to seconds since the epoch"""
+    if not isPickledTime(x):
+        return x
+    return calendar.timegm(cPickle.loads(x).utctimetuple())
 
 
 class FuzzyDict(dict):
@@ -235,6 +265,35 @@ def hostmaskPatternEqual(pattern, hostmask):
         pattern = pattern[1:]
     return ircutils.hostmaskPatternEqual(pattern, hostmask)
 
+# glob characters and rfc1459 case equivalences for compileMask
+_maskTranslate = {
+        '*': '.*',          '?': '.',
+        '[': r'[\[{]',      '{': r'[\[{]',
+        ']': r'[\]}]',      '}': r'[\]}]',
+        '|': r'[|\\]',      '\\': r'[|\\]',
+        '^': r'[\^~]',      '~': r'[\^~]',
+        }
+
+def stripMask(mask):
+    """Strips the quiet prefix and forward channel of a ban mask, returns None
+    if the mask can't match a hostmask, same rules as hostmaskPatternEqual."""
+    if mask.count('!') != 1 or mask.count('@') != 1:
+        return None
+    if mask.count('$') == 1:
+        mask = mask.split('$', 1)[0]
+    if mask.startswith('%'):
+        mask = mask[1:]
+    return mask
+
+def compileMask(mask):
+    """Returns a function that matches hostmasks against the ban <mask>, or
+    None if the mask can't match any hostmask."""
+    mask = stripMask(mask)
+    if mask is None:
+        return None
+    pattern = ''.join([ _maskTranslate.get(c) or re.escape(c) for c in mask ])
+    return re.compile(pattern + '$', re.I).match
+
 def nickMatch(nick, pattern):
     """Checks if a given nick matches a pattern or in a list of patterns."""
     if isinstance(pattern, str):
@@ -245,35 +304,202 @@ def nickMatch(nick, pattern):
             return True
     return False
 
-def dequeue(parent, irc):
-    global queue
-    queue.dequeue(parent, irc)
-
 def supported(irc, mode):
     chanmodes = irc.state.supported.get('chanmodes', '')
     return mode in chanmodes.split(',')[0]
 
+# MsgQueue priorities
+QUERY = 0   # asked for by an operator command
+SYNC = 1    # ban list sync
+
 class MsgQueue(object):
-    def __init__(self):
-        self.msgcache = []
-    def queue(self, msg):
-        if msg not in self.msgcache:
-            self.msgcache.append(msg)
+    """Queries sent to the server, at most <rate> per second on each network
+    with bursts of <burst>. The ban list sync starts <delay> seconds after
+    it's queued, past the replies of a join. Queries asked for by a command
+    are sent at once, somebody is waiting for them, and slow the sync down
+    instead."""
+    def __init__(self, rate=0.5, burst=5, delay=10):
+        self.rate = rate
+        self.burst = burst
+        self.delay = delay
+        self.lock = threading.Lock()
+        # all keyed by network
+        self.ircs = {}
+        self.queues = {}    # deque of the queued messages
+        self.pending = {}   # set of the queued messages
+        self.tokens = {}    # (tokens, time)
+        self.events = {}    # name of the scheduled send
+
+    def queue(self, irc, msg, priority=SYNC):
+        network = irc.network
+        if isinstance(irc, callbacks.ReplyIrcProxy):
+            # keep the connection, not the proxy of a command
+            irc = irc.getRealIrc()
+        self.lock.acquire()
+        try:
+            self.ircs[network] = irc
+            if priority == QUERY:
+                now = time.time()
+                self.tokens[network] = (self._refill(network, now) - 1, now)
+                irc.queueMsg(msg)
+                return
+            pending = self.pending.setdefault(network, set())
+            if msg in pending:
+                return
+            pending.add(msg)
+            self.queues.setdefault(network, deque()).append(msg)
+            self._schedule(network, self.delay)
+        finally:
+            self.lock.release()
+
+    def _refill(self, network, now):
+        tokens, last = self.tokens.get(network, (self.burst, now))
+        return min(self.burst, tokens + (now - last) * self.rate)
+
+    def _send(self, network):
+        """Sends the queued messages allowed by the rate limit, and schedules
+        sending the rest."""
+        now = time.time()
+        tokens = self._refill(network, now)
+        pending = self.pending[network]
+        L = self.queues[network]
+        while tokens >= 1 and L:
+            msg = L.popleft()
+            pending.discard(msg)
+            self.ircs[network].queueMsg(msg)
+            tokens -= 1
+        self.tokens[network] = (tokens, now)
+        if pending:
+            self._schedule(network, max(0, 1 - tokens) / self.rate)
+
+    def _schedule(self, network, delay):
+        if network not in self.events:
+            name = self.events[network] = 'Bantracker_queue_%s' % network
+            schedule.addEvent(lambda: self._wake(network), time.time() + delay, name)
+
+    def _wake(self, network):
+        self.lock.acquire()
+        try:
+            self.events.pop(network, None)
+            self._send(network)
+        finally:
+            self.lock.release()
+
+    def depth(self, irc):
+        """Number of sync messages queued for the network of <irc>."""
+        return len(self.pending.get(irc.network, ()))
+
+    def eta(self, irc):
+        """Seconds needed to send the messages queued for the network of <irc>."""
+        left = self.depth(irc) - self._refill(irc.network, time.time())
+        return max(0, left / self.rate)
+
     def clear(self):
-        self.msgcache = []
-    def dequeue(self, parent, irc):
-        parent.thread_timer.cancel()
-        parent.thread_timer = threading.Timer(10.0, dequeue, args=(parent, irc))
-        if len(self.msgcache):
-            msg = self.msgcache.pop(0)
-            irc.queueMsg(msg)
-        parent.thread_timer.start()
+        self.lock.acquire()
+        try:
+            for name in self.events.itervalues():
+                try:
+                    schedule.removeEvent(name)
+                except KeyError:
+                    pass
+            self.ircs.clear()
+            self.queues.clear()
+            self.pending.clear()
+            self.tokens.clear()
+            self.events.clear()
+        finally:
+            self.lock.release()
 
 queue = MsgQueue()
 
 
+# seconds before a ban with a duration expires its notice is sent
+autoremoveNotice = 600
+
+# seconds a connection waits for the lock of another one before failing
+dbTimeout = 10
+
+# seconds a bans.cgi login session lasts
+sessionTimeout = 2592000 * 3
+
+# lines per block of stored logs
+logBlockSize = 20
+
+def encodeLogBlock(text, compress):
+    if compress:
+        return zlib.compress(text).encode('base64')
+    return text
+
+def decodeLogBlock(data, compressed):
+    if int(compressed):
+        return zlib.decompress(data.decode('base64'))
+    return data
+
+def splitLog(text, size=logBlockSize):
+    """Splits a log stored in bans.log in blocks of <size> lines."""
+    lines = text.splitlines()
+    return [ '\n'.join(lines[i:i + size]) for i in range(0, len(lines), size) ]
+
+_wordRe = re.compile(r'\w+')
+
+def searchWords(text):
+    """Returns the set of words of <text> in the search index, lowercased."""
+    return set([ w for w in _wordRe.findall(text.lower()) if 1 < len(w) <= 32 ])
+
+
+class LogBuffer(object):
+    """Ring buffer with the last <size> lines logged in a channel."""
+    def __init__(self, size):
+        self.lines = deque(maxlen=size)
+        self.bytes = 0
+        self.count = 0 # lines appended so far
+
+    def __len__(self):
+        return len(self.lines)
+
+    def __iter__(self):
+        return iter(self.lines)
+
+    @property
+    def size(self):
+        return self.lines.maxlen
+
+    def append(self, line):
+        lines = self.lines
+        if len(lines) == lines.maxlen:
+            self.bytes -= len(lines[0])
+        lines.append(line)
+        self.bytes += len(line)
+        self.count += 1
+
+    def resize(self, size):
+        if size != self.size:
+            self.lines = deque(self.lines, maxlen=size)
+            self.bytes = sum(map(len, self.lines))
+
+    def blocks(self, size=logBlockSize):
+        """Returns the log split in blocks of <size> lines. Blocks are aligned
+        to the count of lines appended, so a full block is the same in every
+        snapshot that includes it."""
+        L = []
+        block = []
+        n = self.count - len(self.lines)
+        for line in self.lines:
+            block.append(line)
+            n += 1
+            if n % size == 0:
+                L.append('\n'.join(block))
+                block = []
+        if block:
+            L.append('\n'.join(block))
+        return L
+
+
 class Ban(object):
     """Hold my bans"""
+    removed = False # set when dropped from Bantracker.bans
+    future = None   # the write storing the ban, set by _doKickban
+
     def __init__(self, args=None, **kwargs):
         self.id = None
         if args:
@@ -319,6 +545,14 @@ class Ban(object):
     def type(self):
         return guessBanType(self.mask)
 
+    def match(self, hostmask):
+        """Checks if <hostmask> is matched by this ban."""
+        try:
+            f = self._match
+        except AttributeError:
+            f = self._match = compileMask(self.mask)
+        return f is not None and f(hostmask) is not None
+
     def serialize(self):
         id = self.id
         if id is None:
@@ -354,10 +588,518 @@ def guessBanType(mask):
     return 'removal'
 
 
+def banType(mask):
+    """Returns the type stored in ban_types for <mask>: ban, quiet or kick.
+    Marks are recorded when their **MARK** comment is stored."""
+    type = guessBanType(mask)
+    if type == 'removal':
+        return 'kick'
+    elif type == 'mark':
+        return 'ban'
+    return type
+
+class BanIndex(object):
+    """Index of the active bans in the database for quick hostmask lookups.
+
+    Masks are bucketed by their host, ident or nick, whichever is the first
+    without wildcards, masks with wildcards everywhere are kept apart. Masks
+    are compiled only once, so a lookup only tests the candidate masks.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.masks = {}     # mask -> (bucket, key, match function)
+        self.entries = {}   # mask -> {channel: [id, ...]}
+        self.hosts = {}
+        self.idents = {}
+        self.nicks = {}
+        self.wild = set()
+
+    def __len__(self):
+        return sum([ len(ids) for d in self.entries.itervalues()
+                              for ids in d.itervalues() ])
+
+    def _bucket(self, mask):
+        mask = stripMask(mask)
+        nick, _, rest = mask.partition('!')
+        ident, _, host = rest.partition('@')
+        for bucket, key in ((self.hosts, host), (self.idents, ident), (self.nicks, nick)):
+            if key and '*' not in key and '?' not in key:
+                return bucket, ircutils.toLower(key)
+        return None, None
+
+    def add(self, channel, mask, id):
+        f = compileMask(mask)
+        if f is None:
+            # not a hostmask, it can't match anything.
+            return
+        channel = ircutils.toLower(channel)
+        self.lock.acquire()
+        try:
+            if mask not in self.masks:
+                bucket, key = self._bucket(mask)
+                if bucket is None:
+                    self.wild.add(mask)
+                else:
+                    bucket.setdefault(key, set()).add(mask)
+                self.masks[mask] = (bucket, key, f)
+                self.entries[mask] = {}
+            ids = self.entries[mask].setdefault(channel, [])
+            if id not in ids:
+                ids.append(id)
+        finally:
+            self.lock.release()
+
+    def remove(self, channel, mask, id=None):
+        """Removes <mask> from <channel>, only the entry with <id> if given."""
+        channel = ircutils.toLower(channel)
+        self.lock.acquire()
+        try:
+            if mask not in self.entries:
+                return
+            d = self.entries[mask]
+            if channel in d:
+                if id is None:
+                    del d[channel]
+                else:
+                    if id in d[channel]:
+                        d[channel].remove(id)
+                    if not d[channel]:
+                        del d[channel]
+            if not d:
+                del self.entries[mask]
+                bucket, key, f = self.masks.pop(mask)
+                if bucket is None:
+                    self.wild.discard(mask)
+                else:
+                    bucket[key].discard(mask)
+                    if not bucket[key]:
+                        del bucket[key]
+        finally:
+            self.lock.release()
+
+    def match(self, hostmask, channel=None):
+        """Returns a list of (mask, id) of the bans matching <hostmask>, mutes
+        first."""
+        try:
+            nick, ident, host = ircutils.splitHostmask(ircutils.toLower(hostmask))
+        except AssertionError:
+            return []
+        if channel:
+            channel = ircutils.toLower(channel)
+        L = []
+        self.lock.acquire()
+        try:
+            candidates = set(self.wild)
+            for bucket, key in ((self.hosts, host), (self.idents, ident), (self.nicks, nick)):
+                if key in bucket:
+                    candidates.update(bucket[key])
+            for mask in candidates:
+                if self.masks[mask][2](hostmask) is None:
+                    continue
+                for chan, ids in self.entries[mask].iteritems():
+                    if channel and chan != channel:
+                        continue
+                    L.extend([ (mask, id) for id in ids ])
+        finally:
+            self.lock.release()
+        L.sort(key=lambda x: (x[0][0] != '%', x[1]))
+        return L
+
+
+def isWild(s):
+    return '*' in s or '?' in s
+
+def hostPrefixes(host):
+    """Returns the prefixes an address ban like 1.2.3.* can match <host> by:
+    the groups of an IPv6 address, or the leading numeric labels of an IPv4
+    address or of a host named after it."""
+    if ':' in host:
+        sep = ':'
+        parts = host.split(sep)
+    else:
+        sep = '.'
+        parts = []
+        for label in host.split(sep):
+            if not label.isdigit():
+                break
+            parts.append(label)
+    return [ sep.join(parts[:i]) for i in range(1, min(len(parts) + 1, len(host.split(sep)))) ]
+
+class HostmaskDict(dict):
+    """Dict of nick -> hostmask, the hostmasks are indexed by host, host
+    suffix, address prefix and ident so the ones matched by a ban mask can be found without
+    testing all of them."""
+    def __init__(self, size=10000, expire=0, keep=None):
+        dict.__init__(self)
+        self.hosts = {}     # host -> set of nicks
+        self.suffixes = {}  # domain suffix of the host -> set of nicks
+        self.prefixes = {}  # address prefix of the host -> set of nicks
+        self.idents = {}
+        # least recently used order, as a deque of (tick, nick) where only the
+        # last tick of each nick is valid, and nick -> (tick, time)
+        self.order = deque()
+        self.used = {}
+        self.tick = 0
+        self.size = size
+        self.expire = expire
+        self.keep = keep or (lambda nick: False)
+        self.over = 0 # kept nicks allowed over size until the next trim
+        self.hits = self.misses = self.evictions = 0
+        # reads change the order too, and commands run in their own threads
+        self.lock = threading.RLock()
+
+    def _keys(self, hostmask):
+        try:
+            nick, ident, host = ircutils.splitHostmask(ircutils.toLower(hostmask))
+        except AssertionError:
+            return []
+        L = [(self.hosts, host), (self.idents, ident)]
+        for prefix in hostPrefixes(host):
+            L.append((self.prefixes, prefix))
+        if not utils.net.isIP(host):
+            # addresses are banned by prefix, not by suffix
+            parts = host.split('.')
+            for i in range(1, len(parts)):
+                L.append((self.suffixes, '.'.join(parts[i:])))
+        return L
+
+    def _unindex(self, nick, hostmask):
+        for bucket, key in self._keys(hostmask):
+            nicks = bucket.get(key)
+            if nicks is not None:
+                nicks.discard(nick)
+                if not nicks:
+                    del bucket[key]
+
+    def _touch(self, nick, now=None):
+        self.tick += 1
+        self.used[nick] = (self.tick, now or time.time())
+        self.order.append((self.tick, nick))
+        if len(self.order) > 2 * len(self) + 100:
+            # drop the stale entries
+            L = [ (tick, nick) for nick, (tick, _) in self.used.iteritems() ]
+            L.sort()
+            self.order = deque(L)
+
+    def __setitem__(self, nick, hostmask):
+        self.lock.acquire()
+        try:
+            if nick in self:
+                self._unindex(nick, dict.__getitem__(self, nick))
+            dict.__setitem__(self, nick, hostmask)
+            for bucket, key in self._keys(hostmask):
+                bucket.setdefault(key, set()).add(nick)
+            self._touch(nick)
+            if len(self) > self.size + self.over:
+                self.trim()
+        finally:
+            self.lock.release()
+
+    def __delitem__(self, nick):
+        self.lock.acquire()
+        try:
+            self._unindex(nick, self[nick])
+            dict.__delitem__(self, nick)
+            del self.used[nick]
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            dict.clear(self)
+            self.hosts.clear()
+            self.suffixes.clear()
+            self.prefixes.clear()
+            self.idents.clear()
+            self.order.clear()
+            self.used.clear()
+            self.over = 0
+        finally:
+            self.lock.release()
+
+    def get(self, nick, default=None):
+        """Returns the hostmask of <nick>, counting the lookup as a hit or a
+        miss of the cache."""
+        self.lock.acquire()
+        try:
+            if nick in self:
+                self.hits += 1
+                self._touch(nick)
+                return dict.__getitem__(self, nick)
+            self.misses += 1
+            return default
+        finally:
+            self.lock.release()
+
+    def trim(self, now=None):
+        """Evicts the least recently used nicks while there are more than size,
+        and the ones unused for longer than expire seconds, except those keep()
+        is true for, which are moved to the end."""
+        self.lock.acquire()
+        try:
+            if now is None:
+                now = time.time()
+            n = len(self.order)
+            while self.order and n:
+                n -= 1
+                tick, nick = self.order[0]
+                used = self.used.get(nick)
+                if used is None or used[0] != tick:
+                    self.order.popleft()
+                    continue
+                if len(self) <= self.size and not (self.expire and used[1] < now - self.expire):
+                    break
+                self.order.popleft()
+                if self.keep(nick):
+                    self._touch(nick, now)
+                else:
+                    del self[nick]
+                    self.evictions += 1
+            if len(self) > self.size:
+                self.over = len(self) - self.size + self.size // 10
+            else:
+                self.over = 0
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        return 'nick cache %s/%s hostmasks, %s hits, %s misses, %s evictions' \
+               % (len(self), self.size, self.hits, self.misses, self.evictions)
+
+    def _candidates(self, mask):
+        """Returns the nicks whose hostmask might be matched by <mask>, None if
+        all of them can."""
+        try:
+            nick, ident, host = ircutils.splitHostmask(ircutils.toLower(mask))
+        except AssertionError:
+            return None
+        L = []
+        if host and not isWild(host):
+            L.append(self.hosts.get(host, ()))
+        else:
+            # for *.example.com only the hosts ending in .example.com can match,
+            # the suffixes of addresses aren't indexed
+            tail = host[max(host.rfind('*'), host.rfind('?')) + 1:]
+            if tail.startswith('.') and len(tail) > 1 \
+                    and not tail[1:].replace('.', '').isdigit():
+                L.append(self.suffixes.get(tail[1:], ()))
+            # and for 1.2.3.* the hosts starting with 1.2.3.
+            head = re.split(r'[*?]', host, 1)[0]
+            sep = ':' in head and ':' or '.'
+            if sep in head:
+                prefix = head[:head.rfind(sep)]
+                if sep == ':' or prefix.replace('.', '').isdigit():
+                    L.append(self.prefixes.get(prefix, ()))
+        if ident and not isWild(ident):
+            L.append(self.idents.get(ident, ()))
+        if not L:
+            return None
+        return min(L, key=len)
+
+    def match(self, mask):
+        """Returns a hostmask matched by the ban <mask>, or None."""
+        self.lock.acquire()
+        try:
+            nicks = self._candidates(mask)
+            if nicks is None:
+                nicks = self.keys()
+            for nick in nicks:
+                hostmask = self[nick]
+                if ircutils.hostmaskPatternEqual(mask, hostmask):
+                    self.hits += 1
+                    self._touch(nick)
+                    return hostmask
+            self.misses += 1
+            return None
+        finally:
+            self.lock.release()
+
+
+class Membership(object):
+    """Channels each nick is in, kept from the join, part, kick, nick and quit
+    messages, so the channels of a quitting user are known after the IrcState
+    removed them."""
+    def __init__(self):
+        self.nicks = {} # lowered nick -> IrcSet of channels
+
+    def channels(self, nick):
+        return self.nicks.get(ircutils.toLower(nick), ())
+
+    def add(self, nick, channel):
+        key = ircutils.toLower(nick)
+        if key not in self.nicks:
+            self.nicks[key] = ircutils.IrcSet()
+        self.nicks[key].add(channel)
+
+    def remove(self, nick, channel):
+        key = ircutils.toLower(nick)
+        channels = self.nicks.get(key)
+        if channels is not None:
+            channels.discard(channel)
+            if not channels:
+                del self.nicks[key]
+
+    def quit(self, nick):
+        """Removes <nick>, returns the channels it was in."""
+        return self.nicks.pop(ircutils.toLower(nick), ())
+
+    def rename(self, oldNick, newNick):
+        """Moves the channels of <oldNick> to <newNick> and returns them."""
+        channels = self.nicks.pop(ircutils.toLower(oldNick), ())
+        if channels:
+            self.nicks[ircutils.toLower(newNick)] = channels
+        return channels
+
+    def load(self, channel, users):
+        for nick in users:
+            self.add(nick, channel)
+
+    def removeChannel(self, channel):
+        for nick in self.nicks.keys():
+            self.remove(nick, channel)
+
+    def clear(self):
+        self.nicks.clear()
+
+class ReviewQueue(object):
+    """The cached bans not reviewed yet, ordered by the time they were set.
+    The ones a review skipped are held until the next."""
+    def __init__(self):
+        self.heap = [] # (when, seq, ban)
+        self.held = []
+        self.seq = 0
+
+    def __len__(self):
+        return len(self.heap) + len(self.held)
+
+    def push(self, ban):
+        self.seq += 1
+        heapq.heappush(self.heap, (ban.when, self.seq, ban))
+
+    def pop(self, before):
+        """Removes and returns the bans set before the time <before>, oldest
+        first, except those removed since they were pushed."""
+        L = []
+        heap = self.heap
+        while heap and heap[0][0] < before:
+            ban = heapq.heappop(heap)[2]
+            if not ban.removed:
+                L.append(ban)
+        return L
+
+    def hold(self, ban):
+        self.held.append(ban)
+
+    def popHeld(self):
+        """Removes and returns the held bans, except those removed since."""
+        L = [ ban for ban in self.held if not ban.removed ]
+        self.held = []
+        return L
+
+    def clear(self):
+        self.heap = []
+        self.held = []
+
+class Journal(object):
+    """Append-only CSV file with the changes made to a store, replayed by the
+    store when opened. compact() replaces it with the rows of the current
+    state."""
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = None
+        self.writer = None
+        self.records = 0 # rows in the file
+        self.torn = False
+
+    def read(self):
+        """Yields the rows of the file. A last row without its line end was
+        torn by a crash while appending, it isn't yielded and torn is set."""
+        self.records = 0
+        self.torn = False
+        try:
+            f = open(self.filename, 'rb')
+        except IOError:
+            return
+        try:
+            lines = f.readlines()
+        finally:
+            f.close()
+        if lines and not lines[-1].endswith('\n'):
+            self.torn = True
+            lines.pop()
+        for row in csv.reader(lines):
+            self.records += 1
+            yield row
+
+    def replay(self, apply):
+        """Calls apply(row) for each row of the file. Rows that fail, blank
+        or torn ones, are skipped and logged. Returns how many were skipped,
+        the store should compact the journal if any."""
+        skipped = 0
+        for row in self.read():
+            try:
+                apply(row)
+            except Exception, err:
+                skipped += 1
+                log.warning("Bantracker: skipped malformed row %r of %s (%s(%s))",
+                            row, self.filename, type(err).__name__, str(err))
+        if self.torn:
+            skipped += 1
+            log.warning("Bantracker: skipped the torn last row of %s", self.filename)
+        return skipped
+
+    def append(self, *row):
+        try:
+            if self.file is None:
+                self.file = open(self.filename, 'ab')
+                self.writer = csv.writer(self.file)
+            self.writer.writerow(row)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        except (IOError, OSError):
+            return
+        self.records += 1
+
+    def compact(self, rows):
+        self.close()
+        tmp = self.filename + '.tmp'
+        try:
+            f = open(tmp, 'wb')
+            try:
+                writer = csv.writer(f)
+                n = 0
+                for row in rows:
+                    writer.writerow(row)
+                    n += 1
+                f.flush()
+                os.fsync(f.fileno())
+            finally:
+                f.close()
+            os.rename(tmp, self.filename)
+        except (IOError, OSError):
+            return
+        self.records = n
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = self.writer = None
+
 class ReviewStore(dict):
+    """Pending reviews, lowered host -> list of (nick, msg), the ones for a
+    nick without host under None, also indexed by lowered nick in byNick.
+    Use add, remove and replace for the changes to be indexed and saved to the
+    journal."""
     def __init__(self, filename):
-        self.filename = conf.supybot.directories.data.dirize(filename)
-        self.lastReview = 0
+        self.journal = Journal(conf.supybot.directories.data.dirize(filename))
+        self.replaying = False
+        self._lastReview = 0
+        self.byNick = {}
+        self.seen = set()
 
     def __getitem__(self, k):
         try:
@@ -366,34 +1108,137 @@ class ReviewStore(dict):
             self[k] = L = []
             return L
 
-    def open(self):
-        import csv
-        try:
-            reader = csv.reader(open(self.filename, 'rb'))
-        except IOError:
-            return
-        self.lastReview = int(reader.next()[1])
-        for row in reader:
-            host, value = self.deserialize(*row)
-            try:
-                L = self[host]
-                if value not in L:
-                    L.append(value)
-            except KeyError:
-                self[host] = [value]
+    def __setitem__(self, k, v):
+        dict.__setitem__(self, k, v)
+        if k is None:
+            self.byNick.clear()
+            for value in v:
+                self.byNick.setdefault(ircutils.toLower(value[0]), []).append(value)
 
-    def close(self):
-        import csv
+    def __delitem__(self, k):
+        dict.__delitem__(self, k)
+        if k is None:
+            self.byNick.clear()
+
+    def clear(self):
+        dict.clear(self)
+        self.byNick.clear()
+        self.seen.clear()
+
+    def key(self, value):
+        """The same review sent to the same nick, without the link to the
+        ban, is only kept once."""
+        nick, msg = value
+        text = msg.args[1]
+        if ', link: ' in text:
+            text = text.rpartition(', link: ')[0]
+        return (nick, msg.args[0], text)
+
+    def _getLastReview(self):
+        return self._lastReview
+
+    def _setLastReview(self, t):
+        self._lastReview = t
+        self.record('time', str(int(t)))
+
+    lastReview = property(_getLastReview, _setLastReview)
+
+    def record(self, *row):
+        if not self.replaying:
+            self.journal.append(*row)
+            if self.journal.records > 2 * self.count() + 100:
+                self.compact()
+
+    def count(self):
+        return sum(map(len, self.itervalues()))
+
+    def _add(self, host, value):
+        if value[0] == 'Automated-Addition':
+            # bans added by @updatebt, there's nobody to review them
+            return False
+        key = self.key(value)
+        if key in self.seen:
+            return False
+        self.seen.add(key)
+        if host:
+            host = host.lower()
+        dict.setdefault(self, host, []).append(value)
+        if host is None:
+            self.byNick.setdefault(ircutils.toLower(value[0]), []).append(value)
+        return True
+
+    def add(self, host, nick, msg):
+        if self._add(host, (nick, msg)):
+            self.record('+', *self.serialize(host, (nick, msg)))
+
+    def remove(self, host, value=None):
+        """Removes the review <value> of <host>, or all if not given."""
+        if host:
+            host = host.lower()
+        if value is None:
+            if host in self:
+                for v in dict.__getitem__(self, host):
+                    self.seen.discard(self.key(v))
+                del self[host]
+                self.record('-', *self.serialize(host))
+        elif value in self.get(host, ()):
+            L = dict.__getitem__(self, host)
+            L.remove(value)
+            self.seen.discard(self.key(value))
+            if host is None:
+                nicks = self.byNick[ircutils.toLower(value[0])]
+                nicks.remove(value)
+                if not nicks:
+                    del self.byNick[ircutils.toLower(value[0])]
+            if not L:
+                del self[host]
+            self.record('-', *self.serialize(host, value))
+
+    def replace(self, items):
+        """Replaces all the reviews with <items>, a list of (host, nick, msg)."""
+        self.clear()
+        for host, nick, msg in items:
+            self._add(host, (nick, msg))
+        self.compact()
+
+    def open(self):
+        self.replaying = True
         try:
-            writer = csv.writer(open(self.filename, 'wb'))
-        except IOError:
-            return
-        writer.writerow(('time', str(int(self.lastReview))))
+            skipped = self.journal.replay(self.replay)
+        finally:
+            self.replaying = False
+        if skipped:
+            self.compact()
+
+    def replay(self, row):
+        if row[0] == 'time':
+            self.lastReview = int(row[1])
+        elif row[0] == '-':
+            value = self.deserialize(*row[1:])
+            if value is not None:
+                self.remove(*value)
+        else:
+            if row[0] == '+':
+                row = row[1:]
+            value = self.deserialize(*row)
+            if value is not None:
+                host, (nick, msg) = value
+                self.add(host, nick, msg)
+
+    def compact(self):
+        rows = [('time', str(int(self.lastReview)))]
         for host, values in self.iteritems():
             for v in values:
-                writer.writerow(self.serialize(host, v))
+                rows.append(self.serialize(host, v))
+        self.journal.compact(rows)
 
-    def deserialize(self, host, nick, command, channel, text):
+    def close(self):
+        self.compact()
+
+    def deserialize(self, host, nick=None, command=None, channel=None, text=None):
+        host = host or None
+        if nick is None:
+            return (host, None)
         if command == 'PRIVMSG':
             msg = ircmsgs.privmsg(channel, text)
         elif command == 'NOTICE':
@@ -402,7 +1247,10 @@ class ReviewStore(dict):
             return
         return (host, (nick, msg))
 
-    def serialize(self, host, value):
+    def serialize(self, host, value=None):
+        host = host or ''
+        if value is None:
+            return (host,)
         nick, msg = value
         command, channel, text = msg.command, msg.args[0], msg.args[1]
         return (host, nick, command, channel, text)
@@ -422,12 +1270,16 @@ class BanRemoval(object):
     def __getattr__(self, attr):
         return getattr(self.ban, attr)
 
+    @property
+    def deadline(self):
+        return self.when + self.expires
+
     def timeLeft(self):
-        return (self.when + self.expires) - nowSeconds()
+        return self.deadline - nowSeconds()
 
     def expired(self, offset=0):
         """Check if the ban did expire."""
-        if (nowSeconds() + offset) > (self.when + self.expires):
+        if (nowSeconds() + offset) > self.deadline:
             return True
         return False
 
@@ -449,61 +1301,410 @@ def enumerateReversed(L):
         yield i, L[i]
 
 class BanStore(object):
+    """The bans with a duration, indexed by id and by channel and mask, with
+    heaps of their expiry and notice times for finding the next ones."""
     def __init__(self, filename):
-        self.filename = conf.supybot.directories.data.dirize(filename)
-        self.shelf = []
+        self.journal = Journal(conf.supybot.directories.data.dirize(filename))
+        self.replaying = False
+        self.clear()
+
+    def clear(self):
+        self.bans = {}      # id -> BanRemoval
+        self.masks = {}     # (channel, mask) -> set of ids
+        # (time, -seq, BanRemoval), entries of bans removed or replaced are
+        # skipped when they reach the top. Of the bans expiring at the same
+        # time the last added comes first, as it did before the heaps.
+        self.expiry = []
+        self.notices = []
+        self.held = []      # notices skipped by popExpiring, (time, -seq, BanRemoval)
+        self.seq = 0
 
     def __iter__(self):
-        return iter(self.shelf)
+        """The bans, the ones expiring first first."""
+        L = self.bans.values()
+        L.sort(key=lambda x: x.deadline)
+        return iter(L)
 
     def __len__(self):
-        return len(self.shelf)
+        return len(self.bans)
 
     def open(self):
+        self.replaying = True
         try:
-            reader = csv.reader(open(self.filename, 'rb'))
-        except IOError:
+            skipped = self.journal.replay(self.replay)
+        finally:
+            self.replaying = False
+        if skipped:
+            self.compact()
+
+    def replay(self, row):
+        if row[0] == '-':
+            self.remove(int(row[1]))
             return
+        if row[0] == '+':
+            row = row[1:]
+        ban = BanRemoval(None, None)
+        ban.deserialize(row)
+        self.add(ban)
 
-        for row in reader:
-            ban = BanRemoval(None, None)
-            ban.deserialize(row)
-            self.add(ban)
+    def compact(self):
+        self.journal.compact([ ban.serialize() for ban in self ])
 
     def close(self):
-        try:
-            writer = csv.writer(open(self.filename, 'wb'))
-        except IOError:
-            return
+        self.compact()
 
-        for ban in self:
-            writer.writerow(ban.serialize())
+    def record(self, *row):
+        if not self.replaying:
+            self.journal.append(*row)
+            if self.journal.records > 2 * len(self) + 100:
+                self.compact()
 
     def add(self, obj):
-        self.shelf.append(obj)
-
-    def sort(self):
-        """Sort bans by expire date"""
-        def key(x):
-            return x.when + x.expires
+        if obj.id in self.bans:
+            self.remove(obj.id)
+        self.bans[obj.id] = obj
+        self.masks.setdefault((obj.channel, obj.mask), set()).add(obj.id)
+        self.record('+', *obj.serialize())
+        self.seq += 1
+        heapq.heappush(self.expiry, (obj.deadline, -self.seq, obj))
+        if not obj.notified:
+            heapq.heappush(self.notices, (obj.deadline, -self.seq, obj))
+        if len(self.expiry) > 2 * len(self.bans) + 100:
+            self._compactHeaps()
+
+    def get(self, id):
+        return self.bans.get(id)
+
+    def remove(self, id):
+        """Removes and returns the ban with <id>, or None."""
+        obj = self.bans.pop(id, None)
+        if obj is not None:
+            self.record('-', id)
+            key = (obj.channel, obj.mask)
+            ids = self.masks[key]
+            ids.discard(id)
+            if not ids:
+                del self.masks[key]
+            # drop its entries if they're on top, so nextDeadline doesn't
+            # report them.
+            self._top(self.expiry)
+            self._top(self.notices)
+        return obj
+
+    def removeMask(self, channel, mask):
+        """Removes the bans of <mask> in <channel>."""
+        for id in list(self.masks.get((channel, mask), ())):
+            self.remove(id)
+
+    def _compactHeaps(self):
+        self.expiry = [ x for x in self.expiry if self.bans.get(x[2].id) is x[2] ]
+        self.notices = [ x for x in self.notices if self.bans.get(x[2].id) is x[2] ]
+        self.held = [ x for x in self.held if self.bans.get(x[2].id) is x[2] ]
+        heapq.heapify(self.expiry)
+        heapq.heapify(self.notices)
+
+    def _top(self, heap):
+        """Returns the first valid entry of <heap>, or None."""
+        while heap:
+            obj = heap[0][2]
+            if self.bans.get(obj.id) is obj and not (heap is self.notices and obj.notified):
+                return heap[0]
+            heapq.heappop(heap)
+        return None
 
-        self.shelf.sort(key=key, reverse=True)
+    def _pop(self, heap, offset):
+        L = []
+        limit = nowSeconds() + offset
+        top = self._top(heap)
+        while top is not None and top[0] < limit:
+            L.append(heapq.heappop(heap))
+            top = self._top(heap)
+        return L
 
     def popExpired(self, time=0):
         """Pops a list of expired bans"""
+        L = [ x[2] for x in self._pop(self.expiry, time) ]
+        for ban in L:
+            self.remove(ban.id)
+        return L
+
+    def popExpiring(self, time, wanted=None):
+        """Returns the bans expiring in less than <time> seconds that weren't
+        returned before. The ones wanted(ban) is false for are held and
+        checked again in the next call."""
+        for x in self.held:
+            heapq.heappush(self.notices, x)
+        self.held = []
         L = []
-        for i, ban in enumerateReversed(self.shelf):
-            if ban.expired(offset=time):
-                L.append(ban)
-                del self.shelf[i]
+        for x in self._pop(self.notices, time):
+            if wanted is None or wanted(x[2]):
+                L.append(x[2])
+            else:
+                self.held.append(x)
         return L
 
-    def getExpired(self, time=0):
-        def generator():
-            for ban in self.shelf:
-                if ban.expired(offset=time):
-                    yield ban
-        return generator()
+    def setNotified(self, obj):
+        obj.notified = True
+        self.record('+', *obj.serialize())
+
+    def nextDeadline(self, notice=0):
+        """Seconds until the next ban expires, or its notice <notice> seconds
+        before, None if there are no bans."""
+        L = []
+        top = self._top(self.expiry)
+        if top is not None:
+            L.append(top[0])
+        top = self._top(self.notices)
+        if top is not None:
+            L.append(top[0] - notice)
+        if not L:
+            return None
+        return max(0, min(L) - nowSeconds())
+
+class ConnectionPool(object):
+    """Database connections, one per thread. The connections of threads that
+    finished are kept idle and reused by new threads.
+
+    Connections are in autocommit mode, so reads don't hold any lock, writes
+    that should be committed together are grouped with transaction().
+    """
+    def __init__(self, size=4):
+        self.size = size
+        self.lock = threading.Lock()
+        self.connections = {}   # thread -> (filename, connection)
+        self.idle = []
+        self.local = threading.local()
+
+    def _close(self, con):
+        try:
+            con.close()
+        except:
+            pass
+
+    def _collect(self):
+        """Moves the connections of finished threads to the idle list."""
+        for thread in self.connections.keys():
+            if not thread.isAlive():
+                self.idle.append(self.connections.pop(thread))
+        while len(self.idle) > self.size:
+            self._close(self.idle.pop(0)[1])
+
+    def get(self, filename):
+        """Returns the connection of the current thread."""
+        thread = threading.currentThread()
+        self.lock.acquire()
+        try:
+            item = self.connections.get(thread)
+            if item is not None:
+                if item[0] == filename and not item[1].closed:
+                    return item[1]
+                self._close(item[1])
+                del self.connections[thread]
+            self._collect()
+            while self.idle:
+                item = self.idle.pop()
+                if item[0] == filename and not item[1].closed:
+                    break
+                self._close(item[1])
+            else:
+                item = (filename, sqlite.connect(filename, autocommit=1,
+                                                 timeout=dbTimeout))
+            self.connections[thread] = item
+            return item[1]
+        finally:
+            self.lock.release()
+
+    def discard(self):
+        """Closes the connection of the current thread."""
+        self.lock.acquire()
+        try:
+            item = self.connections.pop(threading.currentThread(), None)
+        finally:
+            self.lock.release()
+        if item is not None:
+            self._close(item[1])
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            for filename, con in self.connections.values() + self.idle:
+                self._close(con)
+            self.connections.clear()
+            self.idle = []
+        finally:
+            self.lock.release()
+
+    def inTransaction(self):
+        return getattr(self.local, 'depth', 0) > 0
+
+    @contextmanager
+    def transaction(self, filename):
+        """Runs the statements of the block in a single transaction, nested
+        transactions are merged with the outer one."""
+        if self.inTransaction():
+            self.local.depth += 1
+            try:
+                yield
+            finally:
+                self.local.depth -= 1
+            return
+
+        cur = self.get(filename).cursor()
+        cur.execute("BEGIN")
+        self.local.depth = 1
+        try:
+            yield
+        except:
+            self.local.depth = 0
+            try:
+                cur.execute("ROLLBACK")
+            except:
+                # connection is likely broken, drop it.
+                self.discard()
+            raise
+        else:
+            self.local.depth = 0
+            cur.execute("COMMIT")
+
+class Future(object):
+    """Result of a queued database write."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.event = threading.Event()
+        self.result = None
+        self.callbacks = []
+
+    def done(self):
+        return self.event.isSet()
+
+    def get(self, timeout=None):
+        """Waits for the write and returns its result."""
+        self.event.wait(timeout)
+        return self.result
+
+    def set(self, result):
+        self.lock.acquire()
+        try:
+            self.result = result
+            self.event.set()
+            callbacks, self.callbacks = self.callbacks, []
+        finally:
+            self.lock.release()
+        for f in callbacks:
+            f(result)
+
+    def addCallback(self, f):
+        """Calls f(result) once the write is done."""
+        self.lock.acquire()
+        try:
+            if not self.event.isSet():
+                self.callbacks.append(f)
+                return
+        finally:
+            self.lock.release()
+        f(self.result)
+
+
+class WriteQueue(object):
+    """Database writes, run in batches by a background thread.
+
+    put() queues a function that does the writes, it will be called in a
+    transaction shared with the other writes of its batch. Returns a Future
+    with the return value of the function, or None if it failed.
+    """
+    def __init__(self, plugin, batchSize=50):
+        self.plugin = plugin
+        self.batchSize = batchSize
+        self.queue = Queue.Queue()
+        self.thread = None
+        self.cond = threading.Condition()
+        self.pending = 0
+
+    def __len__(self):
+        return self.pending
+
+    def put(self, f, *args, **kwargs):
+        future = Future()
+        item = (f, args, kwargs, future)
+        if not self.plugin.registryValue('database.writeBehind'):
+            future.set(self._execute([item])[0])
+            return future
+        self.cond.acquire()
+        try:
+            self.pending += 1
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run,
+                                               name='Bantracker writer')
+                self.thread.setDaemon(True)
+                self.thread.start()
+        finally:
+            self.cond.release()
+        self.queue.put(item)
+        return future
+
+    def flush(self, timeout=30):
+        """Waits until the queued writes are done."""
+        if threading.currentThread() is self.thread:
+            return
+        end = time.time() + timeout
+        self.cond.acquire()
+        try:
+            while self.pending and time.time() < end:
+                self.cond.wait(end - time.time())
+        finally:
+            self.cond.release()
+
+    def stop(self):
+        """Runs the queued writes and stops the thread."""
+        thread = self.thread
+        if thread is None:
+            return
+        self.queue.put(None)
+        thread.join()
+
+    def _execute(self, items):
+        try:
+            results = []
+            with self.plugin.transaction():
+                for f, args, kwargs, future in items:
+                    results.append(f(*args, **kwargs))
+            return results
+        except Exception, err:
+            if len(items) > 1:
+                # retry them one by one, so only the bad write is lost.
+                results = []
+                for item in items:
+                    results.extend(self._execute([item]))
+                return results
+            self.plugin.log.error("Bantracker: failed to write to the database (%s(%s))",
+                                  type(err).__name__, str(err))
+            return [None]
+
+    def _run(self):
+        while True:
+            items = [self.queue.get()]
+            while len(items) < self.batchSize:
+                try:
+                    items.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+            stop = None in items
+            items = [ item for item in items if item is not None ]
+            results = self._execute(items)
+            for item, result in zip(items, results):
+                try:
+                    item[3].set(result)
+                except Exception:
+                    self.plugin.log.exception("Bantracker: error in write callback")
+            self.cond.acquire()
+            try:
+                self.pending -= len(items)
+                self.cond.notifyAll()
+            finally:
+                self.cond.release()
+            if stop:
+                self.thread = None
+                break
 
 # opStatus stores in which channels are we currently opped. We define it here
 # in a try-except block so it survives if the plugin is reloaded.
@@ -519,48 +1720,91 @@ class Bantracker(callbacks.Plugin):
     threaded = True
 
     def __init__(self, irc):
+        # the parent's __init__ reads the db property looking for commands.
+        self.dbPool = ConnectionPool()
         self.__parent = super(Bantracker, self)
         self.__parent.__init__(irc)
         self.default_irc = irc
-        self.lastMsgs = {}
-        self.lastStates = {}
+        self.memberships = {}
         self.replies = {}
         self.logs = ircutils.IrcDict()
-        self.nicks = {}
-        self.hosts = {}
+        # cache the timestamp format, it's needed for every line logged.
+        self._timestampCallback = self._updateTimestampFormat
+        self._timestampCallback()
+        conf.supybot.log.timestampFormat.addCallback(self._timestampCallback)
+        self.nicks = HostmaskDict(self.registryValue('nicks.size'),
+                                  self.registryValue('nicks.expire'), self.isTracked)
         self.bans = ircutils.IrcDict()
         self.opped = opStatus
         self.pendingBanremoval = {}
 
-        self.thread_timer = threading.Timer(10.0, dequeue, args=(self,irc))
-        self.thread_timer.start()
+        self._syncCallback = self._updateSyncRate
+        self._syncCallback()
+        conf.supybot.plugins.Bantracker.sync.rate.addCallback(self._syncCallback)
+        conf.supybot.plugins.Bantracker.sync.burst.addCallback(self._syncCallback)
 
-        db = self.registryValue('database')
-        if db:
-            self.db = sqlite.connect(db)
-        else:
-            self.db = None
+        if self.db:
+            try:
+                config.upgradeDatabase(self.db)
+            except Exception, err:
+                self.log.error("Bantracker: failed to upgrade the database (%s(%s))",
+                               type(err).__name__, str(err))
+        self.writeQueue = WriteQueue(self)
+        self.banIndex = BanIndex()
+        self.reviewQueue = ReviewQueue()
+        self.loadBanIndex()
         self.get_bans(irc)
         self.get_bans(irc, mode='q')
+        self.getMembership(irc)
         self.get_nicks(irc)
 
         # init review stuff
         self.pendingReviews = ReviewStore('bt.reviews.db')
         self.pendingReviews.open()
-        self._banreviewfix()
 
         # init autoremove stuff
         self.managedBans = BanStore('bt.autoremove.db')
         self.managedBans.open()
+        self.scheduleAutoRemove(irc)
 
         # add our scheduled events for check bans for reviews or removal
         schedule.addPeriodicEvent(lambda: self.reviewBans(irc), 60*60,
                                   'Bantracker_review')
-        schedule.addPeriodicEvent(lambda: self.autoRemoveBans(irc), 600,
-                                  'Bantracker_autoremove')
+        schedule.addPeriodicEvent(self.expireSessions, 60*60,
+                                  'Bantracker_sessions')
+        schedule.addPeriodicEvent(self.trimNicks, 600, 'Bantracker_nicks')
+
+    def expireSessions(self):
+        """Deletes the bans.cgi login sessions older than sessionTimeout."""
+        self.writeQueue.put(self.db_run, "DELETE FROM sessions WHERE time < %s",
+                            now() - sessionTimeout)
+
+    def getMembership(self, irc):
+        if irc not in self.memberships:
+            members = self.memberships[irc] = Membership()
+            for (channel, c) in irc.state.channels.iteritems():
+                members.load(channel, c.users)
+        return self.memberships[irc]
+
+    def isTracked(self, nick):
+        """Returns True if <nick> is in a channel where the bantracker is enabled."""
+        for members in self.memberships.itervalues():
+            for channel in members.channels(nick):
+                if self.registryValue('enabled', channel):
+                    return True
+        return False
+
+    def trimNicks(self):
+        self.nicks.size = self.registryValue('nicks.size')
+        self.nicks.expire = self.registryValue('nicks.expire')
+        self.nicks.trim()
+
+    def loadBanIndex(self):
+        self.banIndex.clear()
+        for mask, channel, id in self.sort_bans():
+            self.banIndex.add(channel, mask, id)
 
     def get_nicks(self, irc):
-        self.hosts.clear()
         for (channel, c) in irc.state.channels.iteritems():
             if not self.registryValue('enabled', channel):
                 continue
@@ -569,11 +1813,6 @@ class Bantracker(callbacks.Plugin):
                 if not nick in self.nicks:
                     host = self.nick_to_host(irc, nick, False).lower()
                     self.nicks[nick] = host
-                    host = host.split('@', 1)[1]
-                    if '*' not in host:
-                        if host not in self.hosts:
-                            self.hosts[host] = []
-                        self.hosts[host].append(nick)
 
     def get_bans(self, irc, channel=None, mode='b'):
         global queue
@@ -587,7 +1826,7 @@ class Bantracker(callbacks.Plugin):
 
             if channel not in self.bans:
                 self.bans[channel] = []
-            queue.queue(ircmsgs.mode(channel, mode))
+            queue.queue(irc, ircmsgs.mode(channel, mode))
 
         if not channel:
             for channel in irc.state.channels.keys():
@@ -597,7 +1836,7 @@ class Bantracker(callbacks.Plugin):
 
     def sendWhois(self, irc, nick, do_reply=False, *args):
         nick = nick.lower()
-        irc.queueMsg(ircmsgs.whois(nick, nick))
+        queue.queue(irc, ircmsgs.whois(nick, nick), QUERY)
         if do_reply:
             self.replies[nick] = [args[0], args[1:]]
 
@@ -628,7 +1867,8 @@ class Bantracker(callbacks.Plugin):
 
     def do401(self, irc, msg):
         """/whois faild"""
-        irc.queueMsg(ircmsgs.IrcMsg(prefix="", command='WHOWAS', args=(msg.args[1],), msg=msg))
+        queue.queue(irc, ircmsgs.IrcMsg(prefix="", command='WHOWAS', args=(msg.args[1],), msg=msg),
+                    QUERY)
 
     def do406(self, irc, msg):
         """/whowas faild"""
@@ -657,13 +1897,14 @@ class Bantracker(callbacks.Plugin):
             ban = Ban(msg.args)
         if ban not in bans:
             bans.append(ban)
+            self.reviewQueue.push(ban)
 
     def do368(self, irc, msg):
         """End of channel ban list."""
         channel = msg.args[1]
         try:
             bans = self.bans[channel]
-            bans.sort(key=lambda x: x.when) # needed for self.reviewBans
+            bans.sort(key=lambda x: x.when)
         except KeyError:
             pass
 
@@ -681,8 +1922,9 @@ class Bantracker(callbacks.Plugin):
         target = target.lower()
         if ircutils.isUserHostmask(target):
             return target
-        elif target in self.nicks:
-            return self.nicks[target]
+        hostmask = self.nicks.get(target)
+        if hostmask:
+            return hostmask
         elif irc:
             try:
                 return irc.state.nickToHostmask(target)
@@ -700,56 +1942,66 @@ class Bantracker(callbacks.Plugin):
 
     def die(self):
         global queue
-        if self.db:
-            try:
-                self.db.close()
-            except:
-                pass
         try:
-            self.thread_timer.cancel()
-        except:
+            conf.supybot.log.timestampFormat.removeCallback(self._timestampCallback)
+        except AttributeError:
+            pass
+        self.writeQueue.stop()
+        self.dbPool.close()
+        try:
+            conf.supybot.plugins.Bantracker.sync.rate.removeCallback(self._syncCallback)
+            conf.supybot.plugins.Bantracker.sync.burst.removeCallback(self._syncCallback)
+        except AttributeError:
             pass
         queue.clear()
         schedule.removeEvent(self.name() + '_review')
-        schedule.removeEvent(self.name() + '_autoremove')
+        try:
+            schedule.removeEvent(self.name() + '_autoremove')
+        except KeyError:
+            pass
+        schedule.removeEvent(self.name() + '_sessions')
+        schedule.removeEvent(self.name() + '_nicks')
         self.pendingReviews.close()
         self.managedBans.close()
 
     def reset(self):
         global queue
-        if self.db:
-            try:
-                self.db.close()
-            except:
-                pass
+        self.dbPool.close()
         queue.clear()
 #        self.logs.clear()
-        self.lastMsgs.clear()
-        self.lastStates.clear()
+        self.memberships.clear()
 #        self.nicks.clear()
 
-    def __call__(self, irc, msg):
+    @property
+    def db(self):
+        """Database connection of the current thread."""
+        db = self.registryValue('database')
+        if not db:
+            return None
+        return self.dbPool.get(db)
+
+    def transaction(self):
+        """Groups the db_run calls of the block in a single commit:
+
+        with self.transaction():
+            self.db_run(...)
+            self.db_run(...)
+        """
+        return self.dbPool.transaction(self.registryValue('database'))
+
+    def db_run(self, query, parms, expect_result = False, expect_id = False, retry = True, flush = False):
+        if not self.registryValue('database'):
+            self.log.error("Bantracker: no database")
+            return
         try:
-            super(self.__class__, self).__call__(irc, msg)
-            if irc in self.lastMsgs:
-                if irc not in self.lastStates:
-                    self.lastStates[irc] = irc.state.copy()
-                self.lastStates[irc].addMsg(irc, self.lastMsgs[irc])
-        finally:
-            self.lastMsgs[irc] = msg
+            db = self.db
+        except:
+            self.log.error("Bantracker: failed to connect to database")
+            return
 
-    def db_run(self, query, parms, expect_result = False, expect_id = False, retry = True):
-        if not self.db or self.db.closed:
-            db = self.registryValue('database')
-            if db:
-                try:
-                    self.db = sqlite.connect(db)
-                except:
-                    self.log.error("Bantracker: failed to connect to database")
-                    return
-            else:
-                self.log.error("Bantracker: no database")
-                return
+        if (flush or expect_id) and len(self.writeQueue):
+            # the rows we read may still be queued, wait for them.
+            self.writeQueue.flush()
 
         count = 0
         maxCount = 5 #TODO: Make this configurable?
@@ -757,28 +2009,30 @@ class Bantracker(callbacks.Plugin):
 
         while count < maxCount:
             try:
-                cur = self.db.cursor()
+                cur = db.cursor()
                 cur.execute(query, parms)
                 break
             except Exception, err:
                 count += 1
+                if count < maxCount:
+                    # another thread may hold the lock, give it time
+                    time.sleep(0.05 * 2 ** count)
 
         if count == maxCount:
             self.log.error("Bantracker: Error while trying to access the Bantracker database (%s(%s)).", type(err).__name__, str(err))
-            try:
-                self.db.close()
-            except:
-                pass
-            self.db = None # force reconnection to database
+            if self.dbPool.inTransaction():
+                # can't reconnect in the middle of a transaction, let it rollback.
+                raise err
+            self.dbPool.discard() # force reconnection to database
 
             if not retry: # We probably failed twice, so bigger issues than database locking
                 return None
-            return self.db_run(query, parms, expect_result, expect_id, False) # Try again
+            return self.db_run(query, parms, expect_result, expect_id, False, flush) # Try again
 
         data = None
         if expect_result and cur: data = cur.fetchall()
-        if expect_id: data = self.db.insert_id()
-        self.db.commit()
+        if expect_id: data = db.insert_id()
+        # connections are in autocommit mode, nothing to commit here.
         return data
 
     def requestComment(self, irc, channel, ban):
@@ -824,83 +2078,84 @@ class Bantracker(callbacks.Plugin):
             # initialize last time reviewed timestamp
             lastReview = now - reviewTime
 
-        for channel, bans in self.bans.iteritems():
-            if not self.registryValue('enabled', channel) \
-                    or not self.registryValue('review', channel):
+        # the bans held by the last review, and the ones whose review time
+        # passed since, the older ones are dropped without review
+        bans = self.reviewQueue.popHeld()
+        bans.extend([ ban for ban in self.reviewQueue.pop(now - reviewTime)
+                      if ban.when >= lastReview - reviewTime ])
+        enabled = {}
+        reviews = []
+        for ban in bans:
+            channel = ban.channel
+            if channel not in enabled:
+                enabled[channel] = self.registryValue('enabled', channel) \
+                                   and self.registryValue('review', channel)
+            if not enabled[channel]:
+                # review may be enabled later
+                self.reviewQueue.hold(ban)
+                continue
+
+            # XXX this shouldn't be hardcoded, but I'm starting to hate this plugin,
+            # the less I touch it the better.
+            if ban.mask.endswith('$#ubuntu-read-topic'):
                 continue
 
-            for ban in bans:
-                # XXX this shouldn't be hardcoded, but I'm starting to hate this plugin,
-                # the less I touch it the better.
-                if ban.mask.endswith('$#ubuntu-read-topic'):
-                    continue
+            type = ban.type
+            if type in ('removal', 'mark'):
+                # skip kicks and marks
+                continue
 
-                type = ban.type
-                if type in ('removal', 'mark'):
-                    # skip kicks and marks
-                    continue
+            reviews.append(ban)
 
-                # skip bans have a duration set
-                skipBan = False
-                for mban in self.managedBans:
-                    if ban.id == mban.id:
-                        if mban.expires:
-                            skipBan = True
-                        break
-
-                banAge = now - ban.when
-                reviewWindow = lastReview - ban.when
-                #self.log.debug('review ban: %s ban %s by %s (%s/%s/%s %s)', 
-                #        channel, ban.mask, ban.who, reviewWindow, reviewTime,
-                #        banAge, reviewTime - reviewWindow)
-                skipBan = skipBan or banAge < reviewTime
-                if skipBan:
-                    # since we made sure bans are sorted by time, the bans left are more recent
-                    break
-                elif reviewWindow <= reviewTime < banAge:
-                    # ban is old enough, and inside the "review window"
-                    try:
-                        # ban.who should be a user hostmask
-                        nick = ircutils.nickFromHostmask(ban.who)
-                        host = ircutils.hostFromHostmask(ban.who)
-                    except:
-                        if ircutils.isNick(ban.who, strictRfc=True):
-                            # ok, op's nick, use it
-                            nick = ban.who
-                            host = None
-                        else:
-                            # probably a ban restored by IRC server in a netsplit
-                            # XXX see if something can be done about this
-                            continue
-                    if nickMatch(nick, self.registryValue('review.ignore', channel)):
-                        # in the ignore list
-                        continue
-                    if not ban.id:
-                        ban.id = self.get_banId(ban.mask, channel)
-                    mask = ban.mask
-                    if type == 'quiet':
-                        mask = mask[1:]
-                    if nickMatch(nick, self.registryValue('review.forward', channel)):
-                        s = "Review: %s '%s' set by %s on %s in %s, link: %s/bans.cgi?log=%s" \
-                                % (type, 
-                                   mask,
-                                   nick, 
-                                   ban.ascwhen, 
-                                   channel,
-                                   self.registryValue('bansite'),
-                                   ban.id)
-                        self._sendForward(irc, s, 'review', channel)
-                    else:
-                        s = "Review: %s '%s' set on %s in %s, link: %s/bans.cgi?log=%s" \
-                                % (type,
-                                   mask,
-                                   ban.ascwhen,
-                                   channel,
-                                   self.registryValue('bansite'),
-                                   ban.id)
-                        msg = ircmsgs.privmsg(nick, s)
-                        if (nick, msg) not in self.pendingReviews[host]:
-                            self.pendingReviews[host].append((nick, msg))
+        self.resolveBanIds(reviews)
+        for ban in reviews:
+            channel, type = ban.channel, ban.type
+            # skip bans have a duration set
+            mban = self.managedBans.get(ban.id)
+            if mban and mban.expires:
+                # the duration may be removed later
+                self.reviewQueue.hold(ban)
+                continue
+
+            try:
+                # ban.who should be a user hostmask
+                nick = ircutils.nickFromHostmask(ban.who)
+                host = ircutils.hostFromHostmask(ban.who)
+            except:
+                if ircutils.isNick(ban.who, strictRfc=True):
+                    # ok, op's nick, use it
+                    nick = ban.who
+                    host = None
+                else:
+                    # probably a ban restored by IRC server in a netsplit
+                    # XXX see if something can be done about this
+                    continue
+            if nickMatch(nick, self.registryValue('review.ignore', channel)):
+                # in the ignore list
+                continue
+            mask = ban.mask
+            if type == 'quiet':
+                mask = mask[1:]
+            if nickMatch(nick, self.registryValue('review.forward', channel)):
+                s = "Review: %s '%s' set by %s on %s in %s, link: %s/bans.cgi?log=%s" \
+                        % (type, 
+                           mask,
+                           nick, 
+                           ban.ascwhen, 
+                           channel,
+                           self.registryValue('bansite'),
+                           ban.id)
+                self._sendForward(irc, s, 'review', channel)
+            else:
+                s = "Review: %s '%s' set on %s in %s, link: %s/bans.cgi?log=%s" \
+                        % (type,
+                           mask,
+                           ban.ascwhen,
+                           channel,
+                           self.registryValue('bansite'),
+                           ban.id)
+                msg = ircmsgs.privmsg(nick, s)
+                self.pendingReviews.add(host, nick, msg)
 
     def _sendForward(self, irc, s, setting, channel=None):
         if not irc:
@@ -909,45 +2164,21 @@ class Bantracker(callbacks.Plugin):
             msg = ircmsgs.notice(chan, s)
             irc.queueMsg(msg)
 
-    def _banreviewfix(self):
-        # FIXME workaround until proper fix is done.
-        bag = set()
-        nodups = set()
-        for host, reviews in self.pendingReviews.iteritems():
-            for nick, msg in reviews:
-                if nick == 'Automated-Addition':
-                    continue
-                chan, m = msg.args[0], msg.args[1]
-                s = m.rpartition(' ')[0] #remove the url
-                if (nick, chan, s) not in bag:
-                    bag.add((nick, chan, s))
-                    nodups.add((host, nick, msg)) 
-
-        self.pendingReviews.clear()
-
-        for host, nick, msg in nodups:
-            self.pendingReviews[host].append((nick, msg))
-
     def _sendReviews(self, irc, msg):
-        host = ircutils.hostFromHostmask(msg.prefix)
-        if host in self.pendingReviews:
-            self._banreviewfix()
-            for nick, m in self.pendingReviews[host]:
+        reviews = self.pendingReviews
+        host = ircutils.hostFromHostmask(msg.prefix).lower()
+        if host in reviews:
+            for nick, m in reviews[host]:
                 if msg.nick != nick and not irc.isChannel(nick): # I'm a bit extra careful here
                     # correct nick in msg
                     m = ircmsgs.privmsg(msg.nick, m.args[1])
                 irc.queueMsg(m)
-            del self.pendingReviews[host]
+            reviews.remove(host)
         # check if we have any reviews by nick to send
-        if None in self.pendingReviews:
-            L = self.pendingReviews[None]
-            for i, v in enumerate(L):
-                nick, m = v
-                if ircutils.strEqual(msg.nick, nick):
-                    irc.queueMsg(m)
-                    del L[i]
-            if not L:
-                del self.pendingReviews[None]
+        if reviews.byNick:
+            for v in list(reviews.byNick.get(ircutils.toLower(msg.nick), ())):
+                irc.queueMsg(v[1])
+                reviews.remove(None, v)
 
     def getOp(self, irc, channel):
         msg = ircmsgs.privmsg('Chanserv', "op %s %s" % (channel, irc.nick))
@@ -1001,15 +2232,12 @@ class Bantracker(callbacks.Plugin):
                 self.removeBans(irc, channel, modes)
 
         # notify about bans soon to expire
-        for ban in self.managedBans.getExpired(600):
-            if ban.notified:
-                continue
+        def notify(ban):
+            return self.registryValue('autoremove', ban.channel) \
+                   and self.registryValue('autoremove.notify', ban.channel)
 
+        for ban in self.managedBans.popExpiring(autoremoveNotice, notify):
             channel = ban.channel
-            if not self.registryValue('autoremove', channel) \
-                    or not self.registryValue('autoremove.notify', channel):
-                continue
-
             type, mask = ban.type, ban.mask
             if type == 'quiet':
                 mask = mask[1:]
@@ -1022,22 +2250,71 @@ class Bantracker(callbacks.Plugin):
                            ircutils.mircColor(mask, 'teal'),
                            ircutils.mircColor(channel, 'teal')))
                 irc.queueMsg(notice)
-            ban.notified = True
+            self.managedBans.setNotified(ban)
+        self.scheduleAutoRemove(irc)
+
+    def scheduleAutoRemove(self, irc=None):
+        """Runs autoRemoveBans when the next ban expires or its notice is due."""
+        name = self.name() + '_autoremove'
+        try:
+            schedule.removeEvent(name)
+        except KeyError:
+            pass
+        delay = self.managedBans.nextDeadline(autoremoveNotice)
+        if delay is not None:
+            irc = irc or self.default_irc
+            # expired() wants the whole second passed
+            schedule.addEvent(lambda: self.autoRemoveBans(irc), time.time() + delay + 1,
+                              name)
 
     def doLog(self, irc, channel, s):
         if not self.registryValue('enabled', channel):
             return
         channel = ircutils.toLower(channel) 
-        if channel not in self.logs.keys():
-            self.logs[channel] = []
-        format = conf.supybot.log.timestampFormat()
+        try:
+            log = self.logs[channel]
+        except KeyError:
+            log = self.logs[channel] = LogBuffer(self.registryValue('log.depth', channel))
+        format = self.timestampFormat
         if format:
             s = time.strftime(format, time.gmtime()) + " " + ircutils.stripFormatting(s)
-        self.logs[channel] = self.logs[channel][-199:] + [s.strip()]
+        log.append(s.strip())
+
+    def _updateSyncRate(self):
+        queue.rate = self.registryValue('sync.rate')
+        queue.burst = self.registryValue('sync.burst')
+
+    def syncStatus(self, irc):
+        """Returns the number of queued ban list queries and the time left to
+        send them, as a string, or None if there are none."""
+        count = queue.depth(irc)
+        if not count:
+            return None
+        try:
+            left = timeElapsed(queue.eta(irc), short=True)
+        except ValueError:
+            left = 'less than a minute'
+        return '%i, %s left' % (count, left)
+
+    def _updateTimestampFormat(self):
+        self.timestampFormat = conf.supybot.log.timestampFormat()
 
     def doKickban(self, irc, channel, *args, **kwargs):
         ban = self._doKickban(irc, channel, *args, **kwargs)
-        self.requestComment(irc, channel, ban)
+
+        def stored(id):
+            if not id:
+                # failed to store it, there's nothing to comment
+                return
+            if threading.currentThread() is self.writeQueue.thread:
+                # send the request from the IRC thread
+                schedule.addEvent(lambda: self.requestComment(irc, channel, ban), time.time())
+            else:
+                self.requestComment(irc, channel, ban)
+
+        if ban:
+            # we need the ban id for the request, wait until is stored.
+            ban.future.addCallback(stored)
         return ban
 
     def _doKickban(self, irc, channel, operator, target, kickmsg = None, use_time = None,
@@ -1051,40 +2328,123 @@ class Bantracker(callbacks.Plugin):
             nick = ircutils.nickFromHostmask(operator)
         except:
             nick = operator
-        id = self.db_run("INSERT INTO bans (channel, mask, operator, time, log) values(%s, %s, %s, %s, %s)", 
-                          (channel, target, nick, n, '\n'.join(self.logs[channel])), expect_id=True)
-        if kickmsg and id and not (kickmsg == nick):
-            self.db_run("INSERT INTO comments (ban_id, who, comment, time) values(%s,%s,%s,%s)", (id, nick, kickmsg, n))
-        if extra_comment:
-            self.db_run("INSERT INTO comments (ban_id, who, comment, time) values(%s,%s,%s,%s)", (id, nick, extra_comment, n))
-        ban = Ban(mask=target, who=operator, when=time.mktime(time.gmtime()), id=id, channel=channel)
+        log = self.logs[channel]
+        log.resize(self.registryValue('log.depth', channel))
+        blocks = log.blocks()
+        compress = self.registryValue('log.compress')
+
+        def store():
+            id = self.db_run("INSERT INTO bans (channel, mask, operator, time) values(%s, %s, %s, %s)", 
+                              (channel, target, nick, n), expect_id=True)
+            if id:
+                self.db_run("INSERT INTO ban_types (ban_id, type) values(%s, %s)",
+                            (id, banType(target)))
+                self.storeLog(id, blocks, compress)
+            if kickmsg and id and not (kickmsg == nick):
+                self.storeComment(id, nick, kickmsg, n)
+            if extra_comment:
+                self.storeComment(id, nick, extra_comment, n)
+            return id
+
+        def stored(id):
+            ban.id = id
+            if id:
+                self.banIndex.add(channel, target, id)
+
+        ban = Ban(mask=target, who=operator, when=time.mktime(time.gmtime()), channel=channel)
+        ban.future = self.writeQueue.put(store)
+        ban.future.addCallback(stored)
         if add_to_cache:
             if channel not in self.bans:
                 self.bans[channel] = []
             self.bans[channel].append(ban)
+            self.reviewQueue.push(ban)
         return ban
 
+    def storeComment(self, id, nick, comment, time):
+        self.db_run("INSERT INTO comments (ban_id, who, comment, time) values(%s,%s,%s,%s)",
+                    (id, nick, comment, time))
+        if not id:
+            return
+        words = searchWords(comment)
+        if words:
+            data = self.db_run("SELECT word FROM comment_words WHERE ban_id=%s", id, expect_result=True)
+            self.indexWords('comment_words', 'ban_id', id, words - set([ row[0] for row in data or () ]))
+        if comment.startswith('**MARK**'):
+            self.db_run("UPDATE ban_types SET type='mark' WHERE ban_id=%s", id)
+
+    def indexWords(self, table, column, id, words):
+        for word in words:
+            self.db_run("INSERT INTO %s (word, %s) VALUES (%%s, %%s)" % (table, column), (word, id))
+
+    def storeLog(self, id, blocks, compress=False):
+        """Stores the log <blocks> of ban <id>, blocks already in the database
+        are reused."""
+        for seq, text in enumerate(blocks):
+            hash = hashlib.sha1(text).hexdigest()
+            data = self.db_run("SELECT id FROM log_blocks WHERE hash=%s", hash, expect_result=True)
+            if data:
+                block = int(data[0][0])
+            else:
+                block = self.db_run("INSERT INTO log_blocks (hash, compressed, data) VALUES (%s, %s, %s)",
+                                    (hash, int(bool(compress)), encodeLogBlock(text, compress)),
+                                    expect_id=True)
+                self.indexWords('log_words', 'block_id', block, searchWords(text))
+            self.db_run("INSERT INTO ban_logs (ban_id, seq, block_id) VALUES (%s, %s, %s)",
+                        (id, seq, block))
+
+    def getLogs(self, ids):
+        """Returns a dict with the logs of the bans with <ids>, by id. Logs are
+        either in bans.log for old bans, or split in log blocks."""
+        logs = {}
+        missing = []
+        for id, (log,) in self.getBanRows(ids, "log").iteritems():
+            if log:
+                logs[id] = log
+            else:
+                missing.append(id)
+        if not missing:
+            return logs
+        data = self.db_run("SELECT ban_logs.ban_id, log_blocks.compressed, log_blocks.data "
+                           "FROM ban_logs, log_blocks WHERE ban_logs.block_id = log_blocks.id "
+                           "AND ban_logs.ban_id IN (%s) ORDER BY ban_logs.ban_id, ban_logs.seq" \
+                           % ', '.join(['%s'] * len(missing)), missing, expect_result=True)
+        blocks = defaultdict(list)
+        for id, compressed, block in data or ():
+            blocks[int(id)].append(decodeLogBlock(block, compressed))
+        for id in missing:
+            logs[id] = '\n'.join(blocks[id])
+        return logs
+
     def doUnban(self, irc, channel, nick, mask, id = None):
         if id is None and not self.registryValue('enabled', channel):
             return
-        if id is None:
-            data = self.db_run("SELECT id FROM bans where channel=%s and mask=%s and removal is NULL", 
-                               (channel, mask), expect_result=True)
-        else:
-            data = [[id]]
-        if data and len(data):
-            for record in data:
-                if record[0] is not None:
-                    self.db_run("UPDATE bans SET removal=%s , removal_op=%s WHERE id=%s", (now(), nick, int(record[0])))
+        n = now()
+
+        def remove():
+            if id is None:
+                data = self.db_run("SELECT id FROM bans where channel=%s and mask=%s and removal is NULL", 
+                                   (channel, mask), expect_result=True)
+            else:
+                data = [[id]]
+            ids = [ int(record[0]) for record in data or () if record[0] is not None ]
+            for i in ids:
+                self.db_run("UPDATE bans SET removal=%s , removal_op=%s WHERE id=%s", (n, nick, i))
+            return ids
+
+        def removed(ids):
+            for i in ids or ():
+                self.banIndex.remove(channel, mask, i)
+
+        self.writeQueue.put(remove).addCallback(removed)
         if not channel in self.bans:
             self.bans[channel] = []
         for idx, ban in enumerateReversed(self.bans[channel]):
             if ban.mask == mask:
+                ban.removed = True
                 del self.bans[channel][idx]
                 # we don't break here because bans might be duplicated.
-        for idx, br in enumerateReversed(self.managedBans.shelf):
-            if (channel == br.ban.channel) and (mask == br.ban.mask):
-                del self.managedBans.shelf[idx]
+        self.managedBans.removeMask(channel, mask)
 
     def doPrivmsg(self, irc, msg):
         (recipients, text) = msg.args
@@ -1107,10 +2467,9 @@ class Bantracker(callbacks.Plugin):
     def doNick(self, irc, msg):
         oldNick = msg.nick
         newNick = msg.args[0]
-        for (channel, c) in irc.state.channels.iteritems():
-            if newNick in c.users:
-                self.doLog(irc, channel,
-                           '*** %s is now known as %s\n' % (oldNick, newNick))
+        for channel in self.getMembership(irc).rename(oldNick, newNick):
+            self.doLog(irc, channel,
+                       '*** %s is now known as %s\n' % (oldNick, newNick))
         if oldNick.lower() in self.nicks:
             del self.nicks[oldNick.lower()]
         nick = newNick.lower()
@@ -1119,6 +2478,7 @@ class Bantracker(callbacks.Plugin):
 
     def doJoin(self, irc, msg):
         global queue
+        members = self.getMembership(irc)
         for channel in msg.args[0].split(','):
             if msg.nick:
                 self.doLog(irc, channel,
@@ -1130,9 +2490,13 @@ class Bantracker(callbacks.Plugin):
                 if channel in self.opped:
                     del self.opped[channel]
                 if channel in self.bans:
-                    del self.bans[channel]
+                    for ban in self.bans.pop(channel):
+                        ban.removed = True
                 self.get_bans(irc, channel)
                 self.get_bans(irc, channel, 'q')
+                # the users are added at the end of /names
+                members.removeChannel(channel)
+            members.add(msg.nick or msg.prefix, channel)
         nick = msg.nick.lower() or msg.prefix.lower().split('!', 1)[0]
         self.nicks[nick] = msg.prefix.lower()
 
@@ -1152,14 +2516,28 @@ class Bantracker(callbacks.Plugin):
             self.doLog(irc, channel,
                        '*** %s was kicked by %s\n' % (target, msg.nick))
         self.doKickban(irc, channel, msg.prefix, target, kickmsg, extra_comment=host)
+        self.leave(irc, target, channel)
 
     def doPart(self, irc, msg):
         for channel in msg.args[0].split(','):
+            self.leave(irc, msg.nick, channel)
             self.doLog(irc, channel, '*** %s (%s) has left %s (%s)\n' % (msg.nick, msg.prefix, channel, len(msg.args) > 1 and msg.args[1] or ''))
             if len(msg.args) > 1 and msg.args[1].startswith('requested by'):
                 args = msg.args[1].split()
                 self.doKickban(irc, channel, args[2], msg.nick, ' '.join(args[3:]).strip(), extra_comment=msg.prefix)
 
+    def leave(self, irc, nick, channel):
+        if ircutils.strEqual(nick, irc.nick):
+            self.getMembership(irc).removeChannel(channel)
+        else:
+            self.getMembership(irc).remove(nick, channel)
+
+    def do366(self, irc, msg):
+        """End of /names"""
+        channel = msg.args[1]
+        if channel in irc.state.channels:
+            self.getMembership(irc).load(channel, irc.state.channels[channel].users)
+
     def doMode(self, irc, msg):
         channel = msg.args[0]
         if irc.isChannel(channel) and msg.args[1:]:
@@ -1200,8 +2578,6 @@ class Bantracker(callbacks.Plugin):
                     self.doUnban(irc,channel, msg.nick, mask)
 
     def getHostFromBan(self, irc, msg, mask):
-        if irc not in self.lastStates:
-            self.lastStates[irc] = irc.state.copy()
         if mask[0] == '%':
             mask = mask[1:]
         try:
@@ -1212,12 +2588,9 @@ class Bantracker(callbacks.Plugin):
         channel = None
         chan = None
         if mask[0] not in ('*', '?'): # Nick ban
-            if nick in self.nicks:
-                return self.nicks[nick]
+            return self.nicks.get(nick)
         else: # Host/ident ban
-            for (inick, ihost) in self.nicks.iteritems():
-                if ircutils.hostmaskPatternEqual(mask, ihost):
-                    return ihost
+            return self.nicks.match(mask)
         return None
 
     def doTopic(self, irc, msg):
@@ -1228,11 +2601,8 @@ class Bantracker(callbacks.Plugin):
                    '*** %s changes topic to "%s"\n' % (msg.nick, msg.args[1]))
 
     def doQuit(self, irc, msg):
-        if irc not in self.lastStates:
-            self.lastStates[irc] = irc.state.copy()
-        for (channel, chan) in self.lastStates[irc].channels.iteritems():
-            if msg.nick in chan.users:
-                self.doLog(irc, channel, '*** %s (%s) has quit IRC (%s)\n' % (msg.nick, msg.prefix, msg.args[0]))
+        for channel in self.getMembership(irc).quit(msg.nick):
+            self.doLog(irc, channel, '*** %s (%s) has quit IRC (%s)\n' % (msg.nick, msg.prefix, msg.args[0]))
 #            if msg.nick in self.user:
 #                del self.user[msg.nick]
 
@@ -1292,8 +2662,8 @@ class Bantracker(callbacks.Plugin):
             irc.error("No bansite set, please set supybot.plugins.Bantracker.bansite")
             return
         sessid = hashlib.md5('%s%s%d' % (msg.prefix, time.time(), random.randint(1,100000))).hexdigest()
-        self.db_run("INSERT INTO sessions (session_id, user, time) VALUES (%s, %s, %d);",
-            ( sessid, msg.nick, int(time.mktime(time.gmtime())) ) )
+        self.writeQueue.put(self.db_run, "INSERT INTO sessions (session_id, user, time) VALUES (%s, %s, %d);",
+            ( sessid, msg.nick, now() ) )
         irc.reply('Log in at %s/bans.cgi?sess=%s' % (self.registryValue('bansite'), sessid), private=True)
 
     btlogin = wrap(btlogin)
@@ -1337,43 +2707,85 @@ class Bantracker(callbacks.Plugin):
     mark = wrap(mark, [optional('channel'), 'something', additional('text')])
 
     def sort_bans(self, channel=None):
-        data = self.db_run("SELECT mask, removal, channel, id FROM bans", (), expect_result=True)
+        """Returns (mask, channel, id) of the active bans, mutes first. The
+        filtering is done by SQL, using the bans_channel_removal index."""
         if channel:
-            data = [i for i in data if i[2] == channel]
-        bans  = [(i[0], i[3]) for i in data if i[1] == None and '%' not in i[0]]
-        mutes = [(i[0], i[3]) for i in data if i[1] == None and '%' in i[0]]
+            data = self.db_run("SELECT mask, channel, id FROM bans WHERE channel=%s AND removal IS NULL",
+                               channel, expect_result=True)
+        else:
+            data = self.db_run("SELECT mask, channel, id FROM bans WHERE removal IS NULL",
+                               (), expect_result=True)
+        if not data:
+            return []
+        bans  = [(i[0], i[1], int(i[2])) for i in data if '%' not in i[0]]
+        mutes = [(i[0], i[1], int(i[2])) for i in data if '%' in i[0]]
         return mutes + bans
 
-    def get_banId(self, mask, channel):
-        data = self.db_run("SELECT MAX(id) FROM bans WHERE mask=%s AND channel=%s", (mask, channel), True)
-        if data:
-            data = data[0]
-        if not data or not data[0]:
+    def resolveBanIds(self, bans):
+        """Sets the id of the cached Ban objects in <bans> that don't have one,
+        using a single query for all of them."""
+        L = [ ban for ban in bans if ban.id is None ]
+        if not L:
             return
-        return int(data[0])
+        masks = list(set([ ban.mask for ban in L ]))
+        data = self.db_run("SELECT mask, channel, MAX(id) FROM bans WHERE mask IN (%s) "
+                           "GROUP BY mask, channel" % ', '.join(['%s'] * len(masks)),
+                           masks, expect_result=True)
+        ids = {}
+        for mask, channel, id in data or ():
+            if id:
+                ids[(mask, ircutils.toLower(channel))] = int(id)
+        for ban in L:
+            ban.id = ids.get((ban.mask, ircutils.toLower(ban.channel)))
+
+    def getBanRows(self, ids, columns):
+        """Returns a dict with the <columns> of the bans with <ids>, by id."""
+        ids = list(set(ids))
+        if not ids:
+            return {}
+        data = self.db_run("SELECT id, %s FROM bans WHERE id IN (%s)" \
+                           % (columns, ', '.join(['%s'] * len(ids))),
+                           ids, expect_result=True, flush=True)
+        return dict([ (int(row[0]), tuple(row[1:])) for row in data or () ])
+
+    def searchBans(self, words, logs=True, comments=True):
+        """Returns the ids of the bans with all the <words> in their log or
+        comments, newest first."""
+        where = []
+        args = []
+        for word in words:
+            L = []
+            if logs:
+                L.append("id IN (SELECT ban_logs.ban_id FROM log_words, ban_logs "
+                         "WHERE log_words.word=%s AND ban_logs.block_id = log_words.block_id)")
+                args.append(word)
+            if comments:
+                L.append("id IN (SELECT ban_id FROM comment_words WHERE word=%s)")
+                args.append(word)
+            where.append("(%s)" % " OR ".join(L))
+        if not where:
+            return []
+        data = self.db_run("SELECT id FROM bans WHERE %s ORDER BY id DESC" % " AND ".join(where),
+                           args, expect_result=True)
+        return [ int(row[0]) for row in data or () ]
 
     def getBans(self, hostmask, channel):
-        match = []
         if channel:
-            if channel in self.bans and self.bans[channel]:
-                for b in self.bans[channel]:
-                    if hostmaskPatternEqual(b.mask, hostmask):
-                        match.append((b.mask, self.get_banId(b.mask,channel)))
-                data = self.sort_bans(channel)
-                for e in data:
-                    if hostmaskPatternEqual(e[0], hostmask):
-                        if (e[0], e[1]) not in match:
-                            match.append((e[0], e[1]))
+            channels = channel in self.bans and [channel] or []
         else:
-            for c in self.bans:
-                for b in self.bans[c]:
-                    if hostmaskPatternEqual(b.mask, hostmask):
-                        match.append((b.mask, self.get_banId(b.mask,c)))
-            data = self.sort_bans()
-            for e in data:
-                    if hostmaskPatternEqual(e[0], hostmask):
-                        if (e[0], e[1]) not in match:
-                            match.append((e[0], e[1]))
+            channels = self.bans.keys()
+        bans = []
+        for c in channels:
+            bans.extend([ b for b in self.bans[c] if b.match(hostmask) ])
+        for b in bans:
+            if b.id is None and b.future is not None:
+                # just set, its id is known once it's stored
+                b.future.get(30)
+        self.resolveBanIds(bans)
+        match = [ (b.mask, b.id) for b in bans ]
+        for e in self.banIndex.match(hostmask, channel):
+            if e not in match:
+                match.append(e)
         return match
 
     def bansearch_real(self, irc, msg, args, target, channel, from_reply=False, reply=None):
@@ -1384,7 +2796,7 @@ class Bantracker(callbacks.Plugin):
         """
         def format_entry(entry):
             ret = list(entry[:-1])
-            t = cPickle.loads(entry[-1]).astimezone(pytz.timezone('UTC')).strftime("%b %d %Y %H:%M:%S")
+            t = readTime(entry[-1]).strftime("%b %d %Y %H:%M:%S")
             ret.append(t)
             return tuple(ret)
 
@@ -1395,8 +2807,8 @@ class Bantracker(callbacks.Plugin):
         if from_reply:
             if not reply:
                 if capab(user, 'admin'):
-                    if len(queue.msgcache) > 0:
-                            irc.reply("Warning: still syncing (%i)" % len(queue.msgcache))
+                    if self.syncStatus(irc):
+                        irc.reply("Warning: still syncing (%s)" % self.syncStatus(irc))
                 irc.reply("No matches found for %s in %s" % (hostmask, True and channel or "any channel"))
             hostmask = reply
         else:
@@ -1406,8 +2818,8 @@ class Bantracker(callbacks.Plugin):
             return
 
         if capab(user, 'owner'):
-            if len(queue.msgcache) > 0:
-                irc.reply("Warning: still syncing (%i)" % len(queue.msgcache))
+            if self.syncStatus(irc):
+                irc.reply("Warning: still syncing (%s)" % self.syncStatus(irc))
 
         if channel:
             if not ircutils.isChannel(channel):
@@ -1431,9 +2843,10 @@ class Bantracker(callbacks.Plugin):
             return
         ret = []
         replies = []
+        rows = self.getBanRows([ m[1] for m in match if m[1] ], "mask, operator, channel, time")
         for m in match:
-            if m[1]:
-                ret.append((format_entry(self.db_run("SELECT mask, operator, channel, time FROM bans WHERE id=%d", m[1], expect_result=True)[0]), m[1]))
+            if m[1] in rows:
+                ret.append((format_entry(rows[m[1]]), m[1]))
         if not ret:
             done = []
             for c in self.bans:
@@ -1460,6 +2873,40 @@ class Bantracker(callbacks.Plugin):
 
     bansearch = wrap(bansearch_real, ['something', optional('something', default=None)])
 
+    def btsearch(self, irc, msg, args, optlist, text):
+        """[--log | --comment] <text>
+
+        Searches the logs and comments of the bans for the words in <text>,
+        --log or --comment only search the logs or the comments.
+        """
+        if not self.check_auth(irc, msg, args):
+            return
+
+        words = searchWords(text)
+        if not words:
+            irc.error("No words to search for in '%s'" % text)
+            return
+        opts = dict(optlist)
+        if 'log' in opts or 'comment' in opts:
+            ids = self.searchBans(words, logs='log' in opts, comments='comment' in opts)
+        else:
+            ids = self.searchBans(words)
+        if not ids:
+            irc.reply("No matches found for '%s'" % text)
+            return
+
+        rows = self.getBanRows(ids[:10], "mask, operator, channel, time")
+        L = []
+        for id in ids[:10]:
+            mask, operator, channel, t = rows[id]
+            L.append("%s by %s in %s on %s (ID: %s)" \
+                     % (mask, operator, channel, readTime(t).strftime("%b %d %Y"), id))
+        if len(ids) > 10:
+            L.append(Format('%n more', (len(ids) - 10, 'match')))
+        irc.reply(', '.join(L))
+
+    btsearch = wrap(btsearch, [getopts({'log': '', 'comment': ''}), 'text'])
+
     def banlog(self, irc, msg, args, target, channel):
         """<nick|hostmask> [<channel>]
 
@@ -1471,8 +2918,8 @@ class Bantracker(callbacks.Plugin):
         if not user:
             return
 
-        if capab(user, 'owner') and len(queue.msgcache) > 0:
-            irc.reply("Warning: still syncing (%i)" % len(queue.msgcache))
+        if capab(user, 'owner') and self.syncStatus(irc):
+            irc.reply("Warning: still syncing (%s)" % self.syncStatus(irc))
 
         hostmask = self.nick_to_host(irc, target)
         target = target.split('!', 1)[0]
@@ -1483,9 +2930,12 @@ class Bantracker(callbacks.Plugin):
             return
 
         ret = []
+        ids = [ m[1] for m in match if m[1] ]
+        rows = self.getBanRows(ids, "channel")
+        logs = self.getLogs(ids)
         for m in match:
-            if m[1]:
-                ret.append((self.db_run("SELECT log, channel FROM bans WHERE id=%d", m[1], expect_result=True), m[1]))
+            if m[1] in rows:
+                ret.append(([(logs[m[1]], rows[m[1]][0])], m[1]))
 
         sent = []
         if not ret:
@@ -1517,12 +2967,10 @@ class Bantracker(callbacks.Plugin):
         """
 
         def getBans(chan):
-            data = self.db_run("SELECT mask, removal FROM bans WHERE channel=%s", chan, expect_result=True)
+            data = self.sort_bans(chan)
             L = []
-            for mask, removal in data:
-                if removal is not None:
-                    continue
-                elif not isUserHostmask(mask) and mask[0] != '$':
+            for mask, _, _ in data:
+                if not isUserHostmask(mask) and mask[0] != '$':
                     continue
                 L.append(mask)
             return L
@@ -1566,8 +3014,8 @@ class Bantracker(callbacks.Plugin):
         add_res = 0
         rem_res = 0
 
-        if len(queue.msgcache) > 0:
-            irc.reply("Error: still syncing (%i)" % len(queue.msgcache))
+        if self.syncStatus(irc):
+            irc.reply("Error: still syncing (%s)" % self.syncStatus(irc))
             return
 
         try:
@@ -1596,7 +3044,7 @@ class Bantracker(callbacks.Plugin):
         """
 
         def addComment(id, nick, message):
-            self.db_run("INSERT INTO comments (ban_id, who, comment, time) values(%s,%s,%s,%s)", (id, nick, message, now()))
+            self.writeQueue.put(self.storeComment, id, nick, message, now())
 
         if not self.check_auth(irc, msg, args):
             return
@@ -1638,7 +3086,7 @@ class Bantracker(callbacks.Plugin):
     def _getBan(self, id):
         """gets mask, channel and removal date of ban"""
         L = self.db_run("SELECT mask, channel, removal FROM bans WHERE id = %s",
-                        id, expect_result=True)
+                        id, expect_result=True, flush=True)
         if not L:
             raise ValueError
         return L[0]
@@ -1648,11 +3096,9 @@ class Bantracker(callbacks.Plugin):
         or zero, never remove the ban.
         """
         # check if ban has already a duration time
-        for idx, br in enumerate(self.managedBans):
-            if id == br.id:
-                ban = br.ban
-                del self.managedBans.shelf[idx]
-                break
+        br = self.managedBans.remove(id)
+        if br:
+            ban = br.ban
         else:
             if duration < 1:
                 # nothing to do.
@@ -1683,6 +3129,7 @@ class Bantracker(callbacks.Plugin):
         # add ban duration if is positive and non-zero
         if duration > 0:
             self.managedBans.add(BanRemoval(ban, duration))
+        self.scheduleAutoRemove()
 
     def comment(self, irc, msg, args, ids, kickmsg):
         """<id>[,<id> ...] [<comment>][, <duration>]
@@ -1693,10 +3140,11 @@ class Bantracker(callbacks.Plugin):
 
         def addComment(id, nick, msg):
             n = now()
-            self.db_run("INSERT INTO comments (ban_id, who, comment, time) values(%s,%s,%s,%s)", (id, nick, msg, n))
+            self.writeQueue.put(self.storeComment, id, nick, msg, n)
 
         def readComment(id):
-            return self.db_run("SELECT who, comment, time FROM comments WHERE ban_id=%i", (id,), True)
+            return self.db_run("SELECT who, comment, time FROM comments WHERE ban_id=%i", (id,),
+                               expect_result=True, flush=True)
 
         nick = msg.nick
         duration, banset = None, []
@@ -1727,7 +3175,7 @@ class Bantracker(callbacks.Plugin):
                 data = readComment(id)
                 if data:
                     for c in data:
-                        date = cPickle.loads(c[2]).astimezone(pytz.timezone('UTC')).strftime("%b %d %Y %H:%M")
+                        date = readTime(c[2]).strftime("%b %d %Y %H:%M")
                         irc.reply("%s %s: %s" % (date, c[0], c[1].strip()))
                 else:
                     irc.reply("No comments recorded for ban %s" % id)
@@ -1791,11 +3239,7 @@ class Bantracker(callbacks.Plugin):
                 type = guessBanType(mask)
                 if type == 'quiet':
                     mask = mask[1:]
-                for br in self.managedBans:
-                    if br.id == id:
-                        break
-                else:
-                    br = None
+                br = self.managedBans.get(id)
 
                 expires = None
                 if br:
@@ -1833,6 +3277,97 @@ class Bantracker(callbacks.Plugin):
 
     duration = wrap(duration, [optional('something'), optional('text')])
 
+    def btmigrate(self, irc, msg, args, batch):
+        """[<batch size>]
+
+        Converts the times of bans and comments stored as pickled datetime
+        objects to seconds since the epoch, <batch size> rows at a time. The
+        bot keeps working while the conversion is done.
+        """
+        if not self.check_auth(irc, msg, args, 'owner'):
+            return
+
+        def convert(table, key, columns):
+            count = last = 0
+            select = "SELECT %s, %s FROM %s WHERE %s > %%s ORDER BY %s LIMIT %s" \
+                     % (key, ', '.join(columns), table, key, key, batch)
+            update = "UPDATE %s SET %s WHERE %s=%%s" \
+                     % (table, ', '.join([ '%s=%%s' % c for c in columns ]), key)
+            while True:
+                rows = self.db_run(select, last, expect_result=True)
+                if not rows:
+                    return count
+                last = int(rows[-1][0])
+                L = [ [ toEpoch(x) for x in row[1:] ] + [row[0]] for row in rows
+                      if [ x for x in row[1:] if isPickledTime(x) ] ]
+                def write():
+                    for parms in L:
+                        self.db_run(update, tuple(parms))
+                self.writeQueue.put(write).get()
+                count += len(L)
+                self.log.info("Bantracker: converted %s rows in %s", count, table)
+
+        bans = convert('bans', 'id', ('time', 'removal'))
+        comments = convert('comments', 'ROWID', ('time',))
+        irc.reply(Format("Converted the times of %n and %n.", (bans, 'ban'), (comments, 'comment')))
+
+    btmigrate = wrap(btmigrate, [additional('positiveInt', 500)])
+
+    def btindex(self, irc, msg, args, batch):
+        """[<batch size>]
+
+        Adds the logs and comments stored before the search index existed to
+        the index, <batch size> rows at a time. Logs still in bans.log are
+        moved to log blocks. The bot keeps working while the index is built.
+        """
+        if not self.check_auth(irc, msg, args, 'owner'):
+            return
+        compress = self.registryValue('log.compress')
+
+        def index(table, columns, write):
+            count = last = 0
+            select = "SELECT id, %s FROM %s WHERE id > %%s ORDER BY id LIMIT %s" \
+                     % (columns, table, batch)
+            while True:
+                rows = self.db_run(select, last, expect_result=True)
+                if not rows:
+                    return count
+                last = int(rows[-1][0])
+                self.writeQueue.put(write, rows).get()
+                count += len(rows)
+                self.log.info("Bantracker: indexed %s rows of %s", count, table)
+
+        def indexBlocks(rows):
+            ids = [ int(row[0]) for row in rows ]
+            self.db_run("DELETE FROM log_words WHERE block_id IN (%s)" \
+                        % ', '.join(['%s'] * len(ids)), ids)
+            for id, compressed, data in rows:
+                self.indexWords('log_words', 'block_id', int(id),
+                                searchWords(decodeLogBlock(data, compressed)))
+
+        def indexBans(rows):
+            ids = [ int(row[0]) for row in rows ]
+            for id, log in rows:
+                if log:
+                    self.storeLog(int(id), splitLog(log), compress)
+                    self.db_run("UPDATE bans SET log=NULL WHERE id=%s", id)
+            self.db_run("DELETE FROM comment_words WHERE ban_id IN (%s)" \
+                        % ', '.join(['%s'] * len(ids)), ids)
+            data = self.db_run("SELECT ban_id, comment FROM comments WHERE ban_id IN (%s)" \
+                               % ', '.join(['%s'] * len(ids)), ids, expect_result=True)
+            words = defaultdict(set)
+            for id, comment in data or ():
+                words[int(id)].update(searchWords(comment))
+            for id in words:
+                self.indexWords('comment_words', 'ban_id', id, words[id])
+
+        blocks = index('log_blocks', 'compressed, data', indexBlocks)
+        bans = index('bans', 'log', indexBans)
+        irc.reply(Format("Indexed %n and the logs and comments of %n.",
+                         (blocks, 'log block'), (bans, 'ban')))
+
+    btindex = wrap(btindex, [additional('positiveInt', 500)])
+
     def banlink(self, irc, msg, args, id, highlight):
         """<id> [<highlight>]
 
@@ -1866,6 +3401,7 @@ class Bantracker(callbacks.Plugin):
         if key:
             if '@' in key:
                 nick, host = key.split('@', 1)
+                host = host.lower()
             else:
                 nick, host = key, None
             if host in self.pendingReviews:
@@ -1874,17 +3410,11 @@ class Bantracker(callbacks.Plugin):
                 irc.reply('No reviews for %s, use --verbose for check the correct nick@host key.' % key)
                 return
 
-            L = []
-            for _nick, msg in reviews:
+            for _nick, msg in list(reviews):
                 if nick == _nick:
                     irc.reply(msg.args[1])
-                elif flush:
-                    L.append((_nick, msg))
-            if flush:
-                if L:
-                    self.pendingReviews[host] = L
-                else:
-                    del self.pendingReviews[host]
+                    if flush:
+                        self.pendingReviews.remove(host, (_nick, msg))
             return
 
         count = {}
@@ -1907,4 +3437,29 @@ class Bantracker(callbacks.Plugin):
                                           'flush': 'something',
                                           'view': 'something'})])
 
+    def btstats(self, irc, msg, args, channel):
+        """[<channel>]
+
+        Shows the memory used by the channel logs kept for ban records, the
+        state of the nick hostmask cache and of the ban list sync queue.
+        """
+        if not self.check_auth(irc, msg, args):
+            return
+        if channel:
+            if channel not in self.logs:
+                irc.reply("No log kept for %s" % channel)
+                return
+            logs = [ (channel, self.logs[channel]) ]
+        else:
+            logs = self.logs.items()
+            logs.sort()
+        total = sum([ log.bytes for _, log in logs ])
+        L = [ '%s %s/%s lines %.1f KiB' % (chan, len(log), log.size, log.bytes / 1024.0)
+              for chan, log in logs ]
+        irc.reply('Channel logs (%.1f KiB): %s; %s; sync queue %s' %
+                  (total / 1024.0, ', '.join(L), self.nicks.stats(),
+                   self.syncStatus(irc) or 'empty'))
+
+    btstats = wrap(btstats, [additional('validChannel')])
+
 Class = Bantracker
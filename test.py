@@ -39,6 +39,7 @@ class BantrackerTestCase(ChannelPluginTestCase):
     def setUp(self):
         self.setDb()
         super(BantrackerTestCase, self).setUp()
+        pluginConf.database.writeBehind.setValue(False) # write in the same thread
         pluginConf.request.setValue(False) # disable comments
         pluginConf.request.ignore.set('')
         pluginConf.request.forward.set('')
@@ -287,6 +288,45 @@ class BantrackerTestCase(ChannelPluginTestCase):
                 "PRIVMSG op :Review: ban 'asd2!*@*' set on %s in #test, link: "\
                 "%s/bans.cgi?log=2" %(cb.bans['#test'][1].ascwhen, pluginConf.bansite()))
 
+    def testReviewQueue(self):
+        pluginConf.review.setValue(True)
+        cb = self.getCallback()
+        self.feedBan('asd!*@*')
+        self.feedBan('qwe!*@*')
+        self.feedBan('zxc!*@*')
+        self.assertEqual(len(cb.reviewQueue), 3)
+        self.irc.feedMsg(ircmsgs.unban(self.channel, 'qwe!*@*', 'op!user@host.net'))
+        self.assertNotError('duration 3 1w')
+        cb.reviewBans()
+        print 'waiting 2 secs..'
+        time.sleep(2)
+        cb.reviewBans()
+        # the removed ban and the one with a duration aren't reviewed
+        self.assertEqual([ msg.args[1].split("'")[1] for _, msg in cb.pendingReviews['host.net'] ],
+                         ['asd!*@*'])
+        self.assertEqual(len(cb.reviewQueue), 1)
+        # the one with a duration is reviewed once it's removed
+        self.assertNotError('duration 3 -1')
+        cb.reviewBans()
+        self.assertEqual([ msg.args[1].split("'")[1] for _, msg in cb.pendingReviews['host.net'] ],
+                         ['asd!*@*', 'zxc!*@*'])
+        self.assertEqual(len(cb.reviewQueue), 0)
+
+    def testReviewDelivery(self):
+        pr = self.getCallback().pendingReviews
+        s = "Review: ban 'asd!*@*' set on Jan 1 in #test, link: %s/bans.cgi?log=1"
+        pr.add('Host.net', 'op', ircmsgs.privmsg('op', s % 'http://foo'))
+        # same review with another link
+        pr.add('home.net', 'op', ircmsgs.privmsg('op', s % 'http://bar'))
+        pr.add(None, 'Dude', ircmsgs.privmsg('Dude', 'Hello World'))
+        self.assertEqual(sorted(pr.keys()), [None, 'host.net'])
+        self.feedMsg('Hi!', frm='DUDE!user@elsewhere.net')
+        self.assertEqual(str(self.irc.takeMsg()).strip(), 'PRIVMSG Dude :Hello World')
+        self.feedMsg('Hi!', frm='op_!user@HOST.net')
+        self.assertEqual(str(self.irc.takeMsg()).strip(), 'PRIVMSG op_ :' + s % 'http://foo')
+        self.assertFalse(pr)
+        self.assertFalse(pr.byNick)
+
     def testReviewForward(self):
         pluginConf.review.setValue(True)
         pluginConf.review.forward.set('bot')
@@ -369,6 +409,61 @@ class BantrackerTestCase(ChannelPluginTestCase):
         items = pr['home.net']
         self.assertTrue(items[0][0] == 'dude' and items[0][1] == msg4)
 
+    def testStoreJournal(self):
+        """Changes are saved when made, not only when the plugin is unloaded"""
+        import sys
+        cb = self.getCallback()
+        module = sys.modules[cb.__module__]
+        cb.managedBans.clear()
+        cb.managedBans.compact()
+        cb.pendingReviews.replace([])
+        self.feedBan('asd!*@*')
+        self.feedBan('qwe!*@*')
+        self.assertNotError('duration 1 1d')
+        self.assertNotError('duration 2 1w')
+        self.assertNotError('duration 1 -1')
+        store = module.BanStore('bt.autoremove.db')
+        store.open()
+        self.assertEqual([ br.id for br in store ], [2])
+        msg = ircmsgs.privmsg('op', 'Hello World')
+        cb.pendingReviews.add('host.net', 'op', msg)
+        cb.pendingReviews.add('home.net', 'dude', msg)
+        cb.pendingReviews.remove('home.net')
+        store = module.ReviewStore('bt.reviews.db')
+        store.open()
+        self.assertEqual(store.items(), [('host.net', [('op', msg)])])
+
+    def testJournalReplay(self):
+        """A blank row and a last row torn by a crash are skipped when opened"""
+        import sys
+        cb = self.getCallback()
+        module = sys.modules[cb.__module__]
+        cb.managedBans.clear()
+        cb.managedBans.compact()
+        cb.pendingReviews.replace([])
+        self.feedBan('asd!*@*')
+        self.assertNotError('duration 1 1d')
+        msg = ircmsgs.privmsg('op', 'Hello World')
+        cb.pendingReviews.add('host.net', 'op', msg)
+        for store, torn in ((cb.managedBans, '+,604800,0,qwe!*@*,op'),
+                            (cb.pendingReviews, '+,home.net,dude,PRIVMSG,dude,Hel')):
+            store.journal.close()
+            f = open(store.journal.filename, 'ab')
+            f.write('\r\n' + torn)
+            f.close()
+        store = module.BanStore('bt.autoremove.db')
+        store.open()
+        self.assertEqual([ br.id for br in store ], [1])
+        # the journal was rewritten without them, new rows are read back
+        store.add(module.BanRemoval(cb.bans['#test'][0], 600))
+        store = module.BanStore('bt.autoremove.db')
+        store.open()
+        self.assertEqual([ br.id for br in store ], [1])
+        self.assertEqual(store.get(1).expires, 600)
+        store = module.ReviewStore('bt.reviews.db')
+        store.open()
+        self.assertEqual(store.items(), [('host.net', [('op', msg)])])
+
     def testReviewBanreview(self):
         pr = self.getCallback().pendingReviews
         m = ircmsgs.privmsg('#test', 'ban review')
@@ -434,6 +529,26 @@ class BantrackerTestCase(ChannelPluginTestCase):
         self.assertResponse('duration 1 -1', "1 won't expire.")
         self.assertRegexp('duration 1', 'never expires')
 
+    def testDurationCleared(self):
+        self.op()
+        cb = self.getCallback()
+        self.feedBan('asd!*@*')
+        self.assertNotError('duration 1 1')
+        self.assertNotError('duration 1 -1')
+        self.assertEqual(cb.managedBans.nextDeadline(), None)
+        print 'waiting 2 secs ...'
+        time.sleep(2)
+        cb.autoRemoveBans(self.irc)
+        self.assertEqual(self.irc.takeMsg(), None)
+
+    def testDurationNoticeHeld(self):
+        """Notices skipped while notify is off are sent when it's turned on"""
+        cb = self.getCallback()
+        self.feedBan('asd!*@*')
+        self.assertNotError('duration 1 1')
+        self.assertEqual(cb.managedBans.popExpiring(600, lambda ban: False), [])
+        self.assertEqual([ ban.id for ban in cb.managedBans.popExpiring(600) ], [1])
+
     def testDurationMergeModes(self):
         self.op()
         cb = self.getCallback()
@@ -505,19 +620,39 @@ class BantrackerTestCase(ChannelPluginTestCase):
         cb = self.getCallback()
         self.feedBan('asd!*@*')
         self.assertNotError('duration 1 10m')
-        self.assertEqual(cb.managedBans.shelf[0].expires, 600)
+        self.assertEqual(cb.managedBans.get(1).expires, 600)
         self.assertNotError('duration 1 2 weeks')
-        self.assertEqual(cb.managedBans.shelf[0].expires, 1209600)
+        self.assertEqual(cb.managedBans.get(1).expires, 1209600)
         self.assertNotError('duration 1 1m 2 days')
-        self.assertEqual(cb.managedBans.shelf[0].expires, 172860)
+        self.assertEqual(cb.managedBans.get(1).expires, 172860)
         self.assertNotError('duration 1 24h 1day')
-        self.assertEqual(cb.managedBans.shelf[0].expires, 172800)
+        self.assertEqual(cb.managedBans.get(1).expires, 172800)
         self.assertNotError('duration 1 1s1m1h1d1w1M1y')
-        self.assertEqual(cb.managedBans.shelf[0].expires, 34822861)
+        self.assertEqual(cb.managedBans.get(1).expires, 34822861)
         self.assertNotError('duration 1 999')
-        self.assertEqual(cb.managedBans.shelf[0].expires, 999)
+        self.assertEqual(cb.managedBans.get(1).expires, 999)
         self.assertNotError('duration 1 1 second')
-        self.assertEqual(cb.managedBans.shelf[0].expires, 1)
+        self.assertEqual(cb.managedBans.get(1).expires, 1)
+
+    def testDurationSchedule(self):
+        import supybot.schedule as schedule
+        cb = self.getCallback()
+        self.feedBan('asd!*@*')
+        self.feedBan('qwe!*@*')
+        self.assertNotError('duration 1 1h')
+        self.assertNotError('duration 2 2h')
+        self.assertEqual([ br.id for br in cb.managedBans ], [1, 2])
+        # woken for the notice of ban 1, 10 minutes before it expires
+        delay = cb.managedBans.nextDeadline(600)
+        self.assertTrue(abs(cb.managedBans.get(1).timeLeft() - 600 - delay) <= 1)
+        self.assertTrue('Bantracker_autoremove' in schedule.schedule.events)
+        self.assertNotError('duration 1 3h')
+        self.assertEqual([ br.id for br in cb.managedBans ], [2, 1])
+        self.irc.feedMsg(ircmsgs.unban(self.channel, 'qwe!*@*', 'op!user@host.net'))
+        self.assertEqual(cb.managedBans.get(2), None)
+        self.assertEqual(cb.managedBans.masks.keys(), [('#test', 'asd!*@*')])
+        delay = cb.managedBans.nextDeadline(600)
+        self.assertTrue(abs(cb.managedBans.get(1).timeLeft() - 600 - delay) <= 1)
 
     def testDurationTimeFormatBad(self):
         self.assertError('duration 1 10 apples')
@@ -547,11 +682,11 @@ class BantrackerTestCase(ChannelPluginTestCase):
         self.assertNotError('duration 2 1d')
         self.assertNotError('duration 3 1w')
         cb = self.getCallback()
-        cb.managedBans.shelf[1].notified = True
+        cb.managedBans.get(2).notified = True
         cb.managedBans.close()
-        cb.managedBans.shelf = []
+        cb.managedBans.clear()
         cb.managedBans.open()
-        L = cb.managedBans.shelf
+        L = list(cb.managedBans)
         for i, n in enumerate((600, 86400, 604800)):
             self.assertEqual(L[i].expires, n)
         for i, n in enumerate((False, True, False)):
@@ -670,3 +805,327 @@ class BantrackerTestCase(ChannelPluginTestCase):
         self.assertEqual('troll!*@*', obj.mask)
 
 
+
+    def testBanIndex(self):
+        cb = self.getCallback()
+        self.feedBan('troll!*@*')
+        self.feedBan('*!*@trollpit.net', mode='q')
+        self.feedBan('*!*@*.trollpit.net')
+        self.assertEqual(cb.getBans('troll!user@home.net', '#test'),
+                         [('troll!*@*', 1)])
+        self.assertEqual(cb.banIndex.match('Dude!user@trollpit.net'),
+                         [('%*!*@trollpit.net', 2)])
+        self.assertEqual(cb.banIndex.match('dude!user@sub.trollpit.net', '#test'),
+                         [('*!*@*.trollpit.net', 3)])
+        self.assertEqual(cb.banIndex.match('dude!user@sub.trollpit.net', '#other'), [])
+        self.irc.feedMsg(ircmsgs.unban(self.channel, 'troll!*@*',
+                                       'op!user@host.net'))
+        self.assertEqual(cb.banIndex.match('troll!user@home.net'), [])
+        cb.loadBanIndex()
+        self.assertEqual(len(cb.banIndex), 2)
+
+    def testHostmaskIndex(self):
+        cb = self.getCallback()
+        cb.nicks['dude'] = 'dude!~user@sub.trollpit.net'
+        cb.nicks['troll'] = 'troll!troll@home.net'
+        self.assertEqual(cb.getHostFromBan(self.irc, None, '*!*@*.trollpit.net'),
+                         'dude!~user@sub.trollpit.net')
+        self.assertEqual(cb.getHostFromBan(self.irc, None, '%*!*@Sub.TrollPit.net'),
+                         'dude!~user@sub.trollpit.net')
+        self.assertEqual(cb.getHostFromBan(self.irc, None, '*!troll@*'),
+                         'troll!troll@home.net')
+        self.assertEqual(cb.getHostFromBan(self.irc, None, '*!*@*trollpit.net'),
+                         'dude!~user@sub.trollpit.net')
+        cb.nicks['dude'] = 'dude!~user@elsewhere.org'
+        self.assertEqual(cb.getHostFromBan(self.irc, None, '*!*@*.trollpit.net'), None)
+        del cb.nicks['troll']
+        self.assertEqual(cb.getHostFromBan(self.irc, None, '*!troll@*'), None)
+        self.assertEqual(cb.nicks.idents.get('troll'), None)
+        cb.nicks['ip'] = 'ip!~user@1.2.3.4'
+        self.assertEqual(cb.getHostFromBan(self.irc, None, '*!*@1.2.3.*'),
+                         'ip!~user@1.2.3.4')
+        self.assertNotEqual(cb.nicks._candidates('*!*@1.2.3.*'), None)
+        self.assertEqual(cb.nicks.suffixes.get('2.3.4'), None)
+
+    def testNickCache(self):
+        cb = self.getCallback()
+        cb.nicks.clear()
+        size = cb.nicks.size
+        cb.nicks.size = 2
+        try:
+            self.irc.feedMsg(ircmsgs.join(self.channel, prefix='dude!~user@home.net'))
+            cb.nicks['troll'] = 'troll!troll@trollpit.net'
+            cb.nicks['lurker'] = 'lurker!~lurker@lurk.net'
+            # dude is in #test, so troll is the one evicted
+            self.assertEqual(sorted(cb.nicks.keys()), ['dude', 'lurker'])
+            self.assertEqual(cb.nicks.evictions, 1)
+            self.assertEqual(cb.nicks.idents.get('troll'), None)
+            hits, misses = cb.nicks.hits, cb.nicks.misses
+            self.assertEqual(cb.getHostFromBan(self.irc, None, 'lurker!*@*'),
+                             'lurker!~lurker@lurk.net')
+            self.assertEqual(cb.getHostFromBan(self.irc, None, 'troll!*@*'), None)
+            self.assertEqual((cb.nicks.hits, cb.nicks.misses), (hits + 1, misses + 1))
+            # unused for too long
+            cb.nicks.expire = 60
+            cb.nicks.trim(time.time() + 120)
+            self.assertEqual(cb.nicks.keys(), ['dude'])
+            self.assertRegexp('btstats', r'nick cache 1/2 hostmasks, .* 2 evictions')
+        finally:
+            cb.nicks.size = size
+            cb.nicks.expire = pluginConf.nicks.expire()
+
+    def testMembership(self):
+        cb = self.getCallback()
+        members = cb.getMembership(self.irc)
+        self.irc.feedMsg(ircmsgs.join(self.channel, prefix='dude!~user@home.net'))
+        self.assertEqual(list(members.channels('Dude')), [self.channel])
+        self.irc.feedMsg(ircmsgs.nick('dude2', prefix='dude!~user@home.net'))
+        self.assertEqual(list(members.channels('dude')), [])
+        self.irc.feedMsg(ircmsgs.quit('bye', prefix='dude2!~user@home.net'))
+        self.assertEqual(list(members.channels('dude2')), [])
+        lines = list(cb.logs[self.channel])
+        self.assertTrue(lines[-2].endswith('*** dude is now known as dude2'))
+        self.assertTrue(lines[-1].endswith('*** dude2 (dude2!~user@home.net) has quit IRC (bye)'))
+
+    def testSyncQueue(self):
+        import sys
+        import supybot.drivers as drivers
+        import supybot.schedule as schedule
+
+        cb = self.getCallback()
+        queue = sys.modules[cb.__module__].queue
+        queue.clear()
+        pluginConf.sync.rate.setValue(1.0)
+        pluginConf.sync.burst.setValue(1)
+        try:
+            for channel in ('#chan0', '#chan1', '#chan2', '#chan0'):
+                queue.queue(self.irc, ircmsgs.mode(channel, 'b'))
+            self.assertEqual(queue.depth(self.irc), 3)
+            # whois replies are waited by a command, they aren't queued
+            cb.sendWhois(self.irc, 'Dude')
+            self.assertEqual(str(self.irc.takeMsg()).strip(), 'WHOIS dude :dude')
+            self.assertEqual(self.irc.takeMsg(), None)
+            self.assertEqual(queue.depth(self.irc), 3)
+            self.assertRegexp('btstats', r'sync queue 3, ')
+            schedule.rescheduleEvent('Bantracker_queue_%s' % self.irc.network, 1)
+            time.sleep(1.1)
+            drivers.run()
+            msg = self.irc.takeMsg()
+            self.assertEqual(str(msg).strip(), 'MODE #chan0 b')
+            self.assertEqual(self.irc.takeMsg(), None)
+            self.assertEqual(queue.depth(self.irc), 2)
+        finally:
+            queue.clear()
+            pluginConf.sync.rate.setValue(0.5)
+            pluginConf.sync.burst.setValue(5)
+
+    def testDatabaseUpgrade(self):
+        L = [ row[0] for row in self.query(
+                "SELECT name FROM sqlite_master WHERE type='index'") ]
+        for name in ('comments_ban_id', 'bans_channel_removal',
+                     'bans_mask_channel', 'bans_operator'):
+            self.assertTrue(name in L)
+        cb = self.getCallback()
+        self.feedBan('asd!*@*')
+        self.feedBan('qwe!*@*', mode='q')
+        self.feedBan('zxc!*@*', channel='#other')
+        self.assertEqual(cb.sort_bans('#test'),
+                         [('%qwe!*@*', '#test', 2), ('asd!*@*', '#test', 1)])
+        self.irc.feedMsg(ircmsgs.unban(self.channel, 'asd!*@*',
+                                       'op!user@host.net'))
+        self.assertEqual(len(cb.sort_bans()), 2)
+
+    def testBanIdResolve(self):
+        cb = self.getCallback()
+        self.feedBan('troll!*@*')
+        self.feedBan('troll!*@*', channel='#other')
+        cb.bans['#test'] = [] # only keep the ones from the ban list
+        self.irc.feedMsg(ircmsgs.IrcMsg(
+            ':server.net 367 test #test troll!*@* op!user@home.com 123456789'))
+        self.irc.feedMsg(ircmsgs.IrcMsg(
+            ':server.net 367 test #test dude!*@* op!user@home.com 123456789'))
+        self.assertEqual(cb.getBans('troll!user@home.net', '#test'),
+                         [('troll!*@*', 1)])
+        self.assertEqual(cb.bans['#test'][0].id, 1)
+        self.assertEqual(cb.getBans('dude!user@home.net', '#test'),
+                         [('dude!*@*', None)])
+        rows = cb.getBanRows([1, 2, 3], 'mask, channel')
+        self.assertEqual(rows, {1: ('troll!*@*', '#test'), 2: ('troll!*@*', '#other')})
+
+    def testTransaction(self):
+        cb = self.getCallback()
+        try:
+            with cb.transaction():
+                cb.db_run("INSERT INTO comments (ban_id, who, comment, time) values(%s,%s,%s,%s)",
+                          (1, 'op', 'test', '0'))
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(self.query("SELECT count(*) FROM comments")[0][0], 0)
+        with cb.transaction():
+            self.feedBan('asd!*@*')
+            self.feedBan('qwe!*@*')
+        self.assertEqual(self.query("SELECT count(*) FROM bans")[0][0], 2)
+
+    def testConnectionPool(self):
+        import threading
+        cb = self.getCallback()
+        L = []
+        for i in range(2):
+            t = threading.Thread(target=lambda: L.append(cb.db))
+            t.start()
+            t.join()
+        # the connection of the first thread was reused
+        self.assertTrue(L[0] is L[1])
+        self.assertTrue(L[0] is not cb.db)
+
+    def testWriteBehind(self):
+        import supybot.drivers as drivers
+        pluginConf.database.writeBehind.setValue(True)
+        pluginConf.request.setValue(True)
+        try:
+            cb = self.getCallback()
+            self.feedBan('asd!*@*')
+            self.feedBan('qwe!*@*', mode='q')
+            self.irc.feedMsg(ircmsgs.unban(self.channel, 'asd!*@*',
+                                           'op!user@host.net'))
+            # lookups by id wait for the queued ban
+            self.assertEqual(cb._getBan(2)[0], '%qwe!*@*')
+            cb.writeQueue.flush()
+            self.assertEqual(len(cb.writeQueue), 0)
+            self.assertEqual(cb.bans['#test'][0].id, 2)
+            self.assertEqual(cb.bans['#test'][0].future.get(), 2)
+            fetch = self.query("SELECT id, mask FROM bans WHERE removal IS NULL")
+            self.assertEqual([(2, '%qwe!*@*')], fetch)
+            self.assertEqual(cb.banIndex.match('qwe!user@host.net'),
+                             [('%qwe!*@*', 2)])
+            # the comment requests are sent by the IRC thread once the bans
+            # are stored
+            drivers.run()
+            msg = self.irc.takeMsg()
+            self.assertTrue(msg.args[1].endswith("use: @comment 1 <comment>"))
+            msg = self.irc.takeMsg()
+            self.assertTrue(msg.args[1].endswith("use: @comment 2 <comment>"))
+        finally:
+            pluginConf.database.writeBehind.setValue(False)
+            pluginConf.request.setValue(False)
+
+    def testRequestFailedBan(self):
+        """No comment is requested for a ban that couldn't be stored"""
+        cb = self.getCallback()
+        pluginConf.request.setValue(True)
+        try:
+            cb.db_run("DROP TABLE bans", ())
+            self.feedBan('asd!*@*')
+            self.assertEqual(cb.bans['#test'][0].id, None)
+            self.assertEqual(self.irc.takeMsg(), None)
+        finally:
+            pluginConf.request.setValue(False)
+
+    def testLogBuffer(self):
+        cb = self.getCallback()
+        pluginConf.log.depth.setValue(3)
+        try:
+            for i in range(5):
+                self.feedMsg('line %s' % i, frm='dude!user@home.net')
+            log = cb.logs[self.channel]
+            self.assertTrue(len(log) >= 5)
+            self.feedBan('dude!*@*')
+            # resized when the log is stored
+            self.assertEqual(log.size, 3)
+            self.assertEqual(log.bytes, sum(map(len, log)))
+            data = cb.getLogs([1])[1]
+            lines = data.split('\n')
+            self.assertEqual(len(lines), 3)
+            self.assertTrue(lines[0].endswith('<dude> line 3'))
+            self.assertTrue(lines[2].endswith('*** op sets mode: +b dude!*@*'))
+            self.assertRegexp('btstats', r'^Channel logs \(.* KiB\): #test 3/3 lines')
+        finally:
+            pluginConf.log.depth.setValue(200)
+
+    def testLogStore(self):
+        cb = self.getCallback()
+        for i in range(50):
+            self.feedMsg('line %s' % i, frm='dude!user@home.net')
+        self.feedBan('dude!*@*')
+        self.feedBan('dude2!*@*')
+        self.feedBan('dude3!*@*', mode='q')
+        logs = cb.getLogs([1, 2, 3])
+        self.assertTrue(logs[2].startswith(logs[1]))
+        self.assertTrue(logs[3].startswith(logs[2]))
+        self.assertTrue(logs[3].endswith('*** op sets mode: +q dude3!*@*'))
+        # the full blocks are shared by the three bans
+        count = self.query("SELECT count(*) FROM log_blocks")[0][0]
+        total = self.query("SELECT count(*) FROM ban_logs")[0][0]
+        self.assertTrue(count < total)
+        data = self.query("SELECT compressed, data FROM log_blocks")
+        self.assertTrue('line 1' not in data[0][1])
+        # old bans with the log in bans.log
+        cb.db_run("UPDATE bans SET log=%s WHERE id=1", 'old log')
+        self.assertEqual(cb.getLogs([1])[1], 'old log')
+
+    def testBanTypes(self):
+        import sys
+        cb = self.getCallback()
+        self.feedBan('asd!*@*')
+        self.feedBan('qwe!*@*', mode='q')
+        self.feedBan('zxc!*@*')
+        cb.storeComment(3, 'op', '**MARK** - spammer', 1)
+        cb.storeComment(1, 'op', 'not a **MARK**', 2)
+        types = "SELECT ban_id, type FROM ban_types ORDER BY ban_id"
+        self.assertEqual(self.query(types), [(1, 'ban'), (2, 'quiet'), (3, 'mark')])
+        # ban_types filled from the bans and comments when created
+        cb.db_run("DROP TABLE ban_types", ())
+        sys.modules[cb.__module__].config.upgradeDatabase(cb.db)
+        self.assertEqual(self.query(types), [(1, 'ban'), (2, 'quiet'), (3, 'mark')])
+
+    def testSearch(self):
+        cb = self.getCallback()
+        self.feedMsg('buy cheap watches at spam.example.com', frm='dude!user@home.net')
+        self.feedBan('dude!*@*')
+        self.feedMsg('hello there', frm='other!user@home.net')
+        self.feedBan('other!*@*')
+        cb.storeComment(2, 'op', 'Spamming watches in PM', 1)
+        self.assertEqual(cb.searchBans(['watches']), [2, 1])
+        self.assertEqual(cb.searchBans(['watches', 'hello']), [2])
+        self.assertEqual(cb.searchBans(['watches'], logs=False), [2])
+        self.assertEqual(cb.searchBans(['hello', 'pm']), [2])
+        self.assertRegexp('btsearch spam.example.com', r'dude!\*@\* by op in #test .*\(ID: 1\)')
+        self.assertResponse('btsearch --comment cheap', "No matches found for 'cheap'")
+        # old bans with the log in bans.log
+        cb.db_run("DELETE FROM ban_logs WHERE ban_id=1", ())
+        cb.db_run("DELETE FROM log_words", ())
+        cb.db_run("UPDATE bans SET log=%s WHERE id=1", 'selling cheap watches')
+        self.assertEqual(cb.searchBans(['cheap']), [])
+        self.assertRegexp('btindex', 'Indexed .* and the logs and comments of 2 bans.')
+        self.assertEqual(cb.searchBans(['cheap']), [2, 1])
+        self.assertEqual(cb.searchBans(['selling']), [1])
+        self.assertEqual(cb.searchBans(['watches'], logs=False), [2])
+        self.assertEqual(cb.getLogs([1])[1], 'selling cheap watches')
+
+    def testSessionExpiry(self):
+        cb = self.getCallback()
+        cb.db_run("INSERT INTO sessions (session_id, user, time) VALUES (%s, %s, %s)",
+                  ('old', 'op', int(time.time()) - 2592000 * 4))
+        cb.db_run("INSERT INTO sessions (session_id, user, time) VALUES (%s, %s, %s)",
+                  ('new', 'op', int(time.time())))
+        cb.expireSessions()
+        self.assertEqual(self.query("SELECT session_id FROM sessions"), [('new',)])
+
+    def testTimeMigration(self):
+        import cPickle, datetime, pytz
+        cb = self.getCallback()
+        self.feedBan('asd!*@*')
+        self.feedBan('qwe!*@*')
+        self.assertTrue(self.query("SELECT time FROM bans WHERE id=1")[0][0].isdigit())
+        dt = datetime.datetime(2010, 1, 1, 12, 0, 0, tzinfo=pytz.UTC)
+        cb.db_run("UPDATE bans SET time=%s, removal=%s WHERE id=2",
+                  (cPickle.dumps(dt), cPickle.dumps(dt)))
+        cb.db_run("INSERT INTO comments (ban_id, who, comment, time) values(%s,%s,%s,%s)",
+                  (2, 'op', 'old comment', cPickle.dumps(dt)))
+        self.assertRegexp('comment 2', 'Jan 01 2010 12:00 op: old comment')
+        self.assertResponse('btmigrate 1', 'Converted the times of 1 ban and 1 comment.')
+        self.assertEqual(self.query("SELECT time, removal FROM bans WHERE id=2")[0],
+                         ('1262347200', '1262347200'))
+        self.assertRegexp('comment 2', 'Jan 01 2010 12:00 op: old comment')
+        self.assertResponse('btmigrate', 'Converted the times of 0 bans and 0 comments.')